@@ -0,0 +1,215 @@
+"""Headless batch registration.
+
+Runs load -> process -> global registration -> local registration for every source/target pair of a manifest on
+a pool of worker processes and streams one JSON line per pair.
+
+usage: python batch.py manifest.txt [-o results.jsonl] [-j workers] [--voxel-size 0.005] [--fast]
+                       [--multi-hypothesis] [--budget seconds] [--source-filter none] [--target-filter none]
+                       [--target-points N | --voxel-budget seconds] [--stream]
+                       [--stages stages.jsonl] [--quiet] [--method OPEN3D_GREATEST] [--pyramid]
+
+Manifest lines are either "source_path target_path" or a JSON object with "source" and "target" keys.
+Empty lines and lines starting with '#' are ignored. Relative paths are resolved against the manifest directory.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+import open3d as o3d
+
+import filtering
+import instrumentation
+import util
+import voxelsize
+from localregistration import Method
+
+
+default_voxel_size = 0.005
+
+
+def read_manifest(path):
+    base_dir = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                source, target = entry['source'], entry['target']
+            else:
+                source, target = line.split()
+            pairs.append((os.path.join(base_dir, source), os.path.join(base_dir, target)))
+    return pairs
+
+
+def register(result, prepare, fast, multi_hypothesis, budget, method, pyramid):
+    """Global and local registration of one pair, filled into result (poses, fitness, timings or the error).
+
+    prepare(result, timings) loads and processes the pair and returns (source_pcd, target_pcd, target, voxel_size):
+    target is what local registration runs against, target_pcd itself or a TargetIndex of it. batch.py and fanout.py
+    only differ in how they prepare a pair.
+    """
+    timings = {}
+    total = time.perf_counter()
+
+    try:
+        source_pcd, target_pcd, target, voxel_size = prepare(result, timings)
+
+        start = time.perf_counter()
+        global_pose = util.global_registration(source_pcd, target_pcd, voxel_size, fast, multi_hypothesis, budget)
+        timings['global'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pose = util.local_registration(source_pcd, target, global_pose, voxel_size, method, pyramid)
+        timings['local'] = time.perf_counter() - start
+
+        evaluation = o3d.pipelines.registration.evaluate_registration(
+            source_pcd, target_pcd, voxel_size * 0.4, np.asarray(pose))
+        result.update({
+            'source_points': len(source_pcd.points),
+            'target_points': len(target_pcd.points),
+            'global_pose': np.asarray(global_pose).tolist(),
+            'pose': np.asarray(pose).tolist(),
+            'fitness': evaluation.fitness,
+            'inlier_rmse': evaluation.inlier_rmse,
+        })
+    except Exception as e:
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+
+    timings['total'] = time.perf_counter() - total
+    result['timings'] = timings
+    return result
+
+
+def register_pair(job):
+    (source_path, target_path, voxel_size, fast, multi_hypothesis, budget, method, pyramid, filters, auto_voxel,
+     stream) = job
+    result = {'source': source_path, 'target': target_path, 'voxel_size': voxel_size, 'fast': fast,
+              'multi_hypothesis': multi_hypothesis, 'budget': budget, 'method': method.name, 'pyramid': pyramid,
+              'filters': filters, 'stream': stream}
+
+    def prepare(result, timings):
+        if stream:
+            # the files are down sampled while they are read, the full resolution clouds are never held in memory
+            start = time.perf_counter()
+            source_pcd = util.stream_process_pcd(source_path, voxel_size)
+            target_pcd = util.stream_process_pcd(target_path, voxel_size)
+            timings['process'] = time.perf_counter() - start
+            return source_pcd, target_pcd, target_pcd, voxel_size
+
+        start = time.perf_counter()
+        source_pcd = util.load_cloud(source_path)
+        target_pcd = util.load_cloud(target_path)
+        timings['load'] = time.perf_counter() - start
+
+        pair_voxel_size = voxel_size
+        if auto_voxel is not None:
+            start = time.perf_counter()
+            pair_voxel_size = voxelsize.select(source_pcd, target_pcd, **auto_voxel)
+            result['voxel_size'] = pair_voxel_size
+            result['auto_voxel'] = auto_voxel
+            timings['voxel_size'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        source_filter, target_filter = filters
+        source_pcd = util.process_pcd(source_pcd, pair_voxel_size, source_path,
+                                      filters=filtering.presets[source_filter])
+        target_pcd = util.process_pcd(target_pcd, pair_voxel_size, target_path,
+                                      filters=filtering.presets[target_filter])
+        timings['process'] = time.perf_counter() - start
+        return source_pcd, target_pcd, target_pcd, pair_voxel_size
+
+    return register(result, prepare, fast, multi_hypothesis, budget, method, pyramid)
+
+
+def _init_worker(stages_path=None, quiet=False):
+    # keep the pipeline's progress prints off stdout, which carries the JSON lines
+    sys.stdout = sys.stderr
+    instrumentation.set_quiet(quiet)
+    if stages_path is not None:
+        # every worker appends whole lines to the same file
+        instrumentation.add_sink(instrumentation.JsonLinesSink(stages_path))
+
+
+def run(pairs, voxel_size=default_voxel_size, fast=False, multi_hypothesis=False, method=Method.OPEN3D_GREATEST,
+        pyramid=False, workers=None, budget=None, stages_path=None, quiet=False, filters=('none', 'none'),
+        auto_voxel=None, stream=False):
+    """Yield a result dict per pair, in completion order, stage records go to stages_path (JSON lines).
+
+    filters are the (source, target) filtering.presets names. auto_voxel picks the voxel size of every pair instead of
+    voxel_size, it is the voxelsize.select keyword arguments: {'target_points': n} or {'budget': seconds}. stream
+    down samples the files while reading them (util.stream_process_pcd), it takes neither filters nor auto_voxel.
+    """
+    jobs = [(source, target, voxel_size, fast, multi_hypothesis, budget, method, pyramid, filters, auto_voxel, stream)
+            for source, target in pairs]
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(stages_path, quiet)) as pool:
+        for result in pool.imap_unordered(register_pair, jobs):
+            yield result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless batch point cloud registration.")
+    parser.add_argument('manifest')
+    parser.add_argument('-o', '--output', help="JSON lines output file (default: stdout)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--voxel-size', type=float, default=default_voxel_size)
+    parser.add_argument('--fast', action='store_true', help="use FGR instead of RANSAC for global registration")
+    parser.add_argument('--multi-hypothesis', action='store_true',
+                        help="rank several RANSAC/FGR hypotheses instead of trusting a single run")
+    parser.add_argument('--budget', type=float,
+                        help="time budget in seconds for global registration (anytime RANSAC, best pose so far)")
+    parser.add_argument('--source-filter', choices=filtering.presets, default='none',
+                        help="noise filtering of the source before down sampling")
+    parser.add_argument('--target-filter', choices=filtering.presets, default='none',
+                        help="noise filtering of the target before down sampling ('background' also drops the plane)")
+    auto_voxel = parser.add_mutually_exclusive_group()
+    auto_voxel.add_argument('--target-points', type=int,
+                            help="pick the voxel size of every pair for at most this many points per cloud")
+    auto_voxel.add_argument('--voxel-budget', type=float,
+                            help="pick the voxel size of every pair for this global registration time in seconds")
+    parser.add_argument('--stream', action='store_true',
+                        help="down sample .ply/.obj/.npc files while reading them, for scans too large to load")
+    parser.add_argument('--stages', help="append per-stage instrumentation records (JSON lines) to this file")
+    parser.add_argument('--quiet', action='store_true', help="no pipeline progress messages")
+    parser.add_argument('--method', choices=[m.name for m in Method], default=Method.OPEN3D_GREATEST.name)
+    parser.add_argument('--pyramid', action='store_true', help="coarse-to-fine local registration")
+    args = parser.parse_args(argv)
+    if args.stream and (args.source_filter != 'none' or args.target_filter != 'none'):
+        parser.error("--stream can not be combined with --source-filter/--target-filter")
+    if args.stream and (args.target_points is not None or args.voxel_budget is not None):
+        parser.error("--stream needs a fixed --voxel-size")
+
+    pairs = read_manifest(args.manifest)
+    auto_voxel = None
+    if args.target_points is not None:
+        auto_voxel = {'target_points': args.target_points}
+    elif args.voxel_budget is not None:
+        auto_voxel = {'budget': args.voxel_budget}
+    output = open(args.output, 'w') if args.output else sys.stdout
+    failed = 0
+    try:
+        results = run(pairs, args.voxel_size, args.fast, args.multi_hypothesis, Method[args.method], args.pyramid,
+                      args.workers, args.budget, args.stages, args.quiet, (args.source_filter, args.target_filter),
+                      auto_voxel, args.stream)
+        for result in results:
+            failed += 'error' in result
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(":: registered %d pairs, %d failed." % (len(pairs), failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
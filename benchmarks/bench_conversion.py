@@ -0,0 +1,119 @@
+"""GeomNode <-> Open3D/NumPy conversion: vectorized conversion module vs the per-vertex reader/writer loops.
+
+usage: python -m benchmarks.bench_conversion [model ...]
+"""
+import sys
+import time
+
+import numpy as np
+import open3d as o3d
+from panda3d.core import *
+
+import conversion
+import util
+
+
+default_models = ["data/model.obj", "data/scene.obj"]
+repeat = 5
+
+
+# per-vertex implementations the conversion module replaced, kept as the reference to beat
+def loop_mesh_node_to_point_cloud_node(source_node):
+    num_of_vertex = source_node.node().getGeom(0).getVertexData().getNumRows()
+
+    vertex_data = GeomVertexData('pc', GeomVertexFormat.getV3n3c4(), Geom.UH_static)
+    for name in ['vertex', 'normal', 'color']:
+        writer = GeomVertexWriter(vertex_data, name)
+        reader = GeomVertexReader(source_node.node().getGeom(0).getVertexData(), name)
+        while not reader.isAtEnd():
+            writer.addData3(reader.getData3())
+
+    prim = GeomPoints(Geom.UH_static)
+    prim.add_next_vertices(num_of_vertex)
+    geom = Geom(vertex_data)
+    geom.addPrimitive(prim)
+    node = GeomNode('PointCloud')
+    node.addGeom(geom)
+    return NodePath(node)
+
+
+def loop_geom_node_to_pcd(geom_node):
+    pcd = o3d.geometry.PointCloud()
+    vertex_data = geom_node.node().getGeom(0).getVertexData()
+    for name, target in [('vertex', pcd.points), ('normal', pcd.normals), ('color', pcd.colors)]:
+        reader = GeomVertexReader(vertex_data, name)
+        while not reader.isAtEnd():
+            target.append(reader.getData3())
+    return pcd
+
+
+def loop_pcd_to_geom_node(pcd):
+    vertex_data = GeomVertexData('pc', GeomVertexFormat.getV3n3c4(), Geom.UHDynamic)
+    for name, source in [('vertex', pcd.points), ('normal', pcd.normals), ('color', pcd.colors)]:
+        writer = GeomVertexWriter(vertex_data, name)
+        for v in source:
+            writer.addData3(v[0], v[1], v[2])
+
+    prim = GeomPoints(Geom.UH_static)
+    prim.add_next_vertices(len(pcd.points))
+    geom = Geom(vertex_data)
+    geom.addPrimitive(prim)
+    node = GeomNode('PointCloud')
+    node.addGeom(geom)
+    return NodePath(node)
+
+
+def loop_geom_node_to_numpy_pc(geom_node):
+    vertex_data = geom_node.node().getGeom(0).getVertexData()
+    columns = []
+    for name in ['vertex', 'normal']:
+        rows = []
+        reader = GeomVertexReader(vertex_data, name)
+        while not reader.isAtEnd():
+            rows.append(list(reader.getData3()))
+        if len(rows) > 0:
+            columns.append(np.array(rows))
+    return np.hstack(columns).astype(np.float32)
+
+
+def best_of(func, *args):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def check_round_trip(pc_node):
+    points, normals, colors = conversion.geom_node_to_arrays(pc_node)
+    again = conversion.geom_node_to_arrays(conversion.pcd_to_geom_node(conversion.geom_node_to_pcd(pc_node)))
+    for before, after in zip((points, normals, colors), again):
+        assert np.array_equal(before, after), "round trip is not lossless"
+
+
+def run(filepath):
+    mesh_node = util.load_mesh_node(filepath)
+    pc_node = conversion.mesh_node_to_point_cloud_node(mesh_node)
+    pcd = conversion.geom_node_to_pcd(pc_node)
+    check_round_trip(pc_node)
+
+    print(":: %s (%d vertices)" % (filepath, len(pcd.points)))
+    print("   %-32s %10s %10s %8s" % ("stage", "loop", "numpy", "speedup"))
+    cases = [
+        ("mesh_node_to_point_cloud_node", loop_mesh_node_to_point_cloud_node,
+         conversion.mesh_node_to_point_cloud_node, mesh_node),
+        ("geom_node_to_pcd", loop_geom_node_to_pcd, conversion.geom_node_to_pcd, pc_node),
+        ("pcd_to_geom_node", loop_pcd_to_geom_node, conversion.pcd_to_geom_node, pcd),
+        ("geom_node_to_numpy_pc", loop_geom_node_to_numpy_pc, conversion.geom_node_to_numpy_pc, pc_node),
+    ]
+    for name, loop, vectorized, arg in cases:
+        loop_time, _ = best_of(loop, arg)
+        numpy_time, _ = best_of(vectorized, arg)
+        print("   %-32s %9.2fms %9.2fms %7.1fx" % (name, loop_time * 1000, numpy_time * 1000, loop_time / numpy_time))
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or default_models:
+        run(path)
@@ -0,0 +1,102 @@
+"""Downstream time saved by noise filtering: the same pair processed with every filtering preset on the target.
+
+For each preset, filtering, down sampling + normals, global registration (FPFH + RANSAC) and local registration
+(GICP) are timed. The report shows the points removed and the downstream time compared to no filtering.
+
+usage: python -m benchmarks.bench_filtering [--source data/model.obj] [--target data/scene.obj] [--repeat 3]
+                                            [-o bench_filtering.json]
+"""
+import argparse
+import contextlib
+import sys
+
+import numpy as np
+import open3d as o3d
+
+import filtering
+import globalregistration
+import util
+from benchmarks.common import Measure, environment, write_json
+from localregistration import Method
+
+
+def run_preset(name, source, raw_target, voxel_size):
+    globalregistration.featurecache.default_cache.clear()  # the target features change with the filtering
+    row = {'preset': name, 'target_points': len(raw_target.points)}
+
+    with Measure() as measure:
+        target = raw_target
+        if filtering.presets[name] is not None:
+            target, report = filtering.filter_pcd(raw_target, voxel_size, filtering.presets[name])
+            row['removed'] = report['removed']
+        else:
+            row['removed'] = 0
+    row['filter_seconds'] = measure.seconds
+
+    with Measure() as measure:
+        target = util.down_sampling(target, voxel_size)
+    row['process_seconds'] = measure.seconds
+    row['processed_points'] = len(target.points)
+
+    with Measure() as measure:
+        pose = np.asarray(util.global_registration(source, target, voxel_size))
+    row['global_seconds'] = measure.seconds
+
+    with Measure() as measure:
+        pose = np.asarray(util.local_registration(source, target, pose, voxel_size, Method.OPEN3D_GREATEST))
+    row['local_seconds'] = measure.seconds
+
+    row['downstream_seconds'] = row['process_seconds'] + row['global_seconds'] + row['local_seconds']
+    # fitness against the unfiltered scene, so presets are compared on the same points
+    evaluation = o3d.pipelines.registration.evaluate_registration(
+        source, util.down_sampling(raw_target, voxel_size), voxel_size * 1.5, pose)
+    row['fitness'] = evaluation.fitness
+    row['inlier_rmse'] = evaluation.inlier_rmse
+    return row
+
+
+def summarize(rows):
+    print("   %-11s %8s %8s %10s %9s %9s %8s" % ("preset", "removed", "filter", "downstream", "saved", "total",
+                                                "fitness"))
+    baseline = np.mean([r['downstream_seconds'] for r in rows if r['preset'] == 'none'])
+    for name in filtering.presets:
+        group = [r for r in rows if r['preset'] == name]
+        if len(group) == 0:
+            continue
+        filter_seconds = np.mean([r['filter_seconds'] for r in group])
+        downstream = np.mean([r['downstream_seconds'] for r in group])
+        print("   %-11s %8d %7.3fs %9.3fs %8.3fs %8.3fs %8.3f" % (
+            name, group[0]['removed'], filter_seconds, downstream, baseline - downstream,
+            filter_seconds + downstream, np.mean([r['fitness'] for r in group])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default="data/model.obj")
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default="bench_filtering.json")
+    args = parser.parse_args(argv)
+
+    rows = []
+    # keep the per-stage prints of the pipeline out of the report
+    with contextlib.redirect_stdout(sys.stderr):
+        source = util.down_sampling(util.load_pcd(args.source), args.voxel_size)
+        raw_target = util.load_pcd(args.target)
+        for _ in range(args.repeat):
+            for name in filtering.presets:
+                rows.append(run_preset(name, source, raw_target, args.voxel_size))
+
+    summarize(rows)
+    write_json(args.output, {
+        'environment': environment(),
+        'source': args.source,
+        'target': args.target,
+        'voxel_size': args.voxel_size,
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Latency/fitness of the global registration backends: FPFH + RANSAC, FPFH + FGR and PPF surface matching.
+
+Cold runs start without cached FPFH features / trained PPF model, warm runs reuse them (as repeated registrations
+against the same model do). Fitness is measured with the global registration distance threshold, before and after
+a GICP refinement.
+
+usage: python -m benchmarks.bench_global [--source data/model.obj] [--target data/scene.obj] [--repeat 3]
+                                         [-o bench_global.json]
+"""
+import argparse
+import contextlib
+import sys
+
+import numpy as np
+import open3d as o3d
+
+import globalregistration
+import util
+from benchmarks.common import Measure, environment, write_json
+from localregistration import Method
+
+
+backends = ['ransac', 'fgr', 'ppf']
+
+
+def clear_caches():
+    globalregistration.featurecache.default_cache.clear()
+    globalregistration.ppf_cache.clear()
+
+
+def register(backend, source, target, voxel_size):
+    if backend == 'ppf':
+        return globalregistration.ppf(source, target, voxel_size)
+    return globalregistration.ransac_based_on_fpfh(source, target, voxel_size, backend == 'fgr')
+
+
+def run_backend(backend, source, target, voxel_size, repeat):
+    rows = []
+    for warm in (False, True):
+        for _ in range(repeat if warm else 1):
+            if not warm:
+                clear_caches()
+            with Measure() as measure:
+                pose = np.asarray(register(backend, source, target, voxel_size))
+            refined = np.asarray(util.local_registration(source, target, pose, voxel_size, Method.OPEN3D_GREATEST))
+
+            distance = voxel_size * 1.5
+            evaluation = o3d.pipelines.registration.evaluate_registration(source, target, distance, pose)
+            refined_evaluation = o3d.pipelines.registration.evaluate_registration(source, target, distance, refined)
+            rows.append({
+                'backend': backend,
+                'warm': warm,
+                'seconds': measure.seconds,
+                'peak_memory': measure.peak_memory,
+                'fitness': evaluation.fitness,
+                'inlier_rmse': evaluation.inlier_rmse,
+                'refined_fitness': refined_evaluation.fitness,
+                'refined_inlier_rmse': refined_evaluation.inlier_rmse,
+            })
+    return rows
+
+
+def summarize(rows):
+    print("   %-8s %-5s %9s %9s %9s %9s" % ("backend", "warm", "seconds", "peak MB", "fitness", "refined"))
+    for backend in backends:
+        for warm in (False, True):
+            group = [r for r in rows if r['backend'] == backend and r['warm'] == warm]
+            if len(group) == 0:
+                continue
+            print("   %-8s %-5s %8.3fs %9.1f %9.3f %9.3f" % (
+                backend, warm,
+                np.mean([r['seconds'] for r in group]),
+                max(r['peak_memory'] for r in group) / 2 ** 20,
+                np.mean([r['fitness'] for r in group]),
+                np.mean([r['refined_fitness'] for r in group])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default="data/model.obj")
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--backends', nargs='+', choices=backends, default=backends)
+    parser.add_argument('--repeat', type=int, default=3, help="warm runs per backend")
+    parser.add_argument('-o', '--output', default="bench_global.json")
+    args = parser.parse_args(argv)
+
+    rows = []
+    # keep the per-stage prints of the pipeline out of the report
+    with contextlib.redirect_stdout(sys.stderr):
+        source = util.process_pcd(util.load_pcd(args.source), args.voxel_size)
+        target = util.process_pcd(util.load_pcd(args.target), args.voxel_size)
+        for backend in args.backends:
+            rows.extend(run_backend(backend, source, target, args.voxel_size, args.repeat))
+
+    summarize(rows)
+    write_json(args.output, {
+        'environment': environment(),
+        'source': args.source,
+        'target': args.target,
+        'voxel_size': args.voxel_size,
+        'source_points': len(source.points),
+        'target_points': len(target.points),
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
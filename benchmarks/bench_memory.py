@@ -0,0 +1,105 @@
+"""Peak memory of loading and processing a large scan: Open3D PointCloud, CompactCloud and streaming.
+
+A scan of --points points is synthesized from the target (copies jittered by a fraction of the voxel size) and
+written as .ply and .npc. Every mode then runs in a fresh process, so each peak is measured from the same baseline:
+
+- open3d: util.load_pcd + util.process_pcd, the float64 path
+- compact: util.load_cloud + util.process_pcd, float32/uint8 with float32 down sampling
+- compact_npc: the same from the memory-mapped .npc file
+- stream: the .ply down sampled chunk by chunk while it is read, as util.stream_process_pcd (without its cache)
+
+usage: python -m benchmarks.bench_memory [--target data/scene.obj] [--points 3000000] [-o bench_memory.json]
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import open3d as o3d
+
+import pcformat
+import streaming
+import util
+from benchmarks.common import Measure, environment, write_json
+
+
+modes = ('open3d', 'compact', 'compact_npc', 'stream')
+
+
+def synthesize(path, count, voxel_size, seed=0):
+    points, normals, colors = pcformat.read_source(path)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(points), count)
+    points = points[picks] + rng.normal(0, voxel_size / 4, (count, 3)).astype(np.float32)
+    normals = np.zeros((count, 3), dtype=np.float32) if normals is None else normals[picks]
+    colors = rng.random((count, 3), dtype=np.float32) if colors is None else colors[picks]
+    return points, normals, colors
+
+
+def run_mode(mode, ply_path, npc_path, voxel_size):
+    with contextlib.redirect_stdout(sys.stderr), Measure() as measure:
+        start = time.perf_counter()
+        if mode == 'stream':
+            # reading is part of down sampling here
+            load_seconds = 0.0
+            processed = util.estimate_normals(streaming.stream_down_sample(ply_path, voxel_size).to_pcd(), voxel_size)
+        else:
+            if mode == 'open3d':
+                cloud = util.load_pcd(ply_path)
+            else:
+                cloud = util.load_cloud(npc_path if mode == 'compact_npc' else ply_path)
+            load_seconds = time.perf_counter() - start
+            processed = util.process_pcd(cloud, voxel_size)
+    return {'mode': mode, 'load_seconds': load_seconds, 'process_seconds': measure.seconds - load_seconds,
+            'peak_memory': measure.peak_memory, 'processed_points': len(processed.points)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--points', type=int, default=3000000)
+    parser.add_argument('-o', '--output', default="bench_memory.json")
+    args = parser.parse_args(argv)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        ply_path = os.path.join(directory, 'scan.ply')
+        npc_path = os.path.join(directory, 'scan.npc')
+        with contextlib.redirect_stdout(sys.stderr):
+            points, normals, colors = synthesize(args.target, args.points, args.voxel_size)
+        pcformat.write(npc_path, points, normals, colors)
+        # float32 points/normals and uint8 colors, as scanners write them
+        ply = o3d.t.geometry.PointCloud(o3d.core.Tensor(points))
+        ply.point['normals'] = o3d.core.Tensor(normals)
+        ply.point['colors'] = o3d.core.Tensor(np.rint(colors * 255).astype(np.uint8))
+        o3d.t.io.write_point_cloud(ply_path, ply)
+        del ply
+        del points, normals, colors
+
+        context = multiprocessing.get_context('spawn')
+        for mode in modes:
+            with context.Pool(1) as pool:
+                rows.append(pool.apply(run_mode, (mode, ply_path, npc_path, args.voxel_size)))
+
+    print("   %d points" % args.points)
+    print("   %-12s %9s %9s %12s %10s" % ("mode", "load", "process", "peak memory", "processed"))
+    for row in rows:
+        print("   %-12s %8.3fs %8.3fs %9.1f MB %10d" % (row['mode'], row['load_seconds'], row['process_seconds'],
+                                                        row['peak_memory'] / 2 ** 20, row['processed_points']))
+
+    write_json(args.output, {
+        'environment': environment(),
+        'target': args.target,
+        'voxel_size': args.voxel_size,
+        'points': args.points,
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Micro-benchmarks of the pipeline building blocks, with stored baselines and a regression check.
+
+Every cloud is resampled to each --scales factor of its point count (a random subset below 1, jittered copies above)
+and the stages run on it headlessly, best of --repeat runs:
+
+- conversion: mesh_node_to_point_cloud_node, geom_node_to_pcd, pcd_to_geom_node
+- util.down_sampling, globalregistration.fpfh (cold feature cache)
+- every localregistration function, registering the processed cloud to a copy of itself moved by a small fixed pose
+
+usage: python -m benchmarks.bench_micro run [--clouds ...] [--scales 0.5 1 4] [--repeat 5] [-o bench_micro.json]
+                                            [--compare [BASELINE]] [--tolerance 0.25]
+       python -m benchmarks.bench_micro compare bench_micro.json [BASELINE] [--tolerance 0.25] [--min-seconds 0.001]
+
+A baseline is a run saved under another name. benchmarks/bench_micro_baseline.json, the default, is a run of the
+default clouds and scales; refresh it with run -o benchmarks/bench_micro_baseline.json when the pipeline gets faster
+or the reference machine changes. compare flags every stage whose best time grew by more than --tolerance
+(0.25 = 25%) and by more than --min-seconds, and exits with 1 if any did.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import open3d as o3d
+
+import conversion
+import featurecache
+import globalregistration
+import instrumentation
+import localregistration
+import util
+from benchmarks.common import environment, write_json
+from compactcloud import CompactCloud
+from localregistration import Method
+
+
+default_clouds = ["data/model.obj", "data/scene.obj", "data/ColoredICP/frag_115.ply", "data/ColoredICP/scene.ply",
+                  "data/ColoredICP/skin_classic_left.ply"]
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_micro_baseline.json")
+voxel_sizes = {'frag_115.ply': 0.02}  # a room fragment, the other clouds are table-top scans
+default_voxel_size = 0.005
+
+
+def resample(cloud, scale, voxel_size, seed=0):
+    """CompactCloud with round(len * scale) points of cloud: a subset, or jittered copies when scale > 1."""
+    rng = np.random.default_rng(seed)
+    count = max(1, int(round(len(cloud) * scale)))
+    if scale <= 1:
+        picks = np.sort(rng.choice(len(cloud), count, replace=False))
+        jitter = 0
+    else:
+        picks = rng.integers(0, len(cloud), count)
+        jitter = rng.normal(0, voxel_size / 4, (count, 3)).astype(np.float32)
+    return CompactCloud(cloud.points[picks] + jitter, None if cloud.normals is None else cloud.normals[picks],
+                        None if cloud.colors is None else cloud.colors[picks], cloud.name)
+
+
+def moved_copy(pcd, voxel_size):
+    # 2 degrees about z and two voxels along x, well inside the basin of every local method
+    angle = np.radians(2)
+    pose = np.eye(4)
+    pose[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    pose[0, 3] = 2 * voxel_size
+    return o3d.geometry.PointCloud(pcd).transform(pose)
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def stages(cloud, voxel_size):
+    """(name, func, args) of every stage on one resampled cloud."""
+    node = cloud.to_geom_node()
+    pc_node = conversion.mesh_node_to_point_cloud_node(node)
+    pcd = conversion.geom_node_to_pcd(pc_node)
+    source = util.down_sampling(pcd, voxel_size)
+    target = moved_copy(source, voxel_size)
+    identity = np.eye(4)
+
+    cases = [
+        ('mesh_node_to_point_cloud_node', conversion.mesh_node_to_point_cloud_node, (node,)),
+        ('geom_node_to_pcd', conversion.geom_node_to_pcd, (pc_node,)),
+        ('pcd_to_geom_node', conversion.pcd_to_geom_node, (pcd,)),
+        ('down_sampling', util.down_sampling, (pcd, voxel_size)),
+        # a cache of its own per call, so every run computes the features
+        ('fpfh', lambda: globalregistration.fpfh(source, voxel_size, featurecache.FeatureCache(max_entries=1)), ()),
+        ('open3d_icp', localregistration.open3d_icp, (source, target, identity, voxel_size)),
+        ('open3d_gicp', localregistration.open3d_gicp, (source, target, identity, voxel_size)),
+        ('opencv_icp', localregistration.opencv_icp, (source, target, identity)),
+        ('pyramid_registration', localregistration.pyramid_registration,
+         (Method.OPEN3D_GREATEST, source, target, identity, voxel_size)),
+    ]
+    if cloud.has_colors():
+        cases.append(('colored_icp', localregistration.colored_icp, (source, target, identity, voxel_size)))
+    return cases, len(source.points)
+
+
+def run(clouds, scales, repeat):
+    rows = []
+    for path in clouds:
+        name = os.path.basename(path)
+        voxel_size = voxel_sizes.get(name, default_voxel_size)
+        raw = util.load_cloud(path)
+        for scale in scales:
+            cloud = resample(raw, scale, voxel_size)
+            cases, processed_points = stages(cloud, voxel_size)
+            for stage, func, args in cases:
+                row = {'cloud': name, 'scale': scale, 'points': len(cloud), 'processed_points': processed_points,
+                       'voxel_size': voxel_size, 'stage': stage, 'repeat': repeat}
+                try:
+                    row['best'], row['median'] = best_of(repeat, func, *args)
+                except Exception as e:
+                    row['error'] = "%s: %s" % (type(e).__name__, e)
+                rows.append(row)
+    return rows
+
+
+def row_key(row):
+    return "%s x%g %s" % (row['cloud'], row['scale'], row['stage'])
+
+
+def compare(current, baseline, tolerance=0.25, min_seconds=0.001):
+    """Rows of current whose best time regressed against baseline, and the comparison table of all stages."""
+    baseline_rows = {row_key(row): row for row in baseline['rows'] if 'best' in row}
+    table = []
+    regressions = []
+    for row in current['rows']:
+        key = row_key(row)
+        before = baseline_rows.get(key)
+        if before is None or 'best' not in row:
+            table.append((key, None if before is None else before['best'], row.get('best'), None, row.get('error')))
+            continue
+        ratio = row['best'] / before['best'] if before['best'] > 0 else float('inf')
+        regressed = ratio > 1 + tolerance and row['best'] - before['best'] > min_seconds
+        table.append((key, before['best'], row['best'], ratio, "REGRESSION" if regressed else None))
+        if regressed:
+            regressions.append(row)
+    return regressions, table
+
+
+def report(current, baseline, tolerance, min_seconds):
+    for field in ('cpu_count', 'open3d', 'numpy', 'python'):
+        if current['environment'].get(field) != baseline['environment'].get(field):
+            print("   warning: %s differs from the baseline (%s against %s)" % (
+                field, current['environment'].get(field), baseline['environment'].get(field)))
+    regressions, table = compare(current, baseline, tolerance, min_seconds)
+    print("   %-56s %10s %10s %7s" % ("stage", "baseline", "current", "ratio"))
+    for key, before, after, ratio, note in table:
+        print(("   %-56s %10s %10s %7s %s" % (
+            key, "-" if before is None else "%.2fms" % (before * 1000),
+            "-" if after is None else "%.2fms" % (after * 1000), "-" if ratio is None else "%.2fx" % ratio,
+            note or "")).rstrip())
+    print(":: %d of %d stages slower than the baseline by more than %d%%." % (
+        len(regressions), len(table), round(tolerance * 100)))
+    return 1 if regressions else 0
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run the micro-benchmarks")
+    run_parser.add_argument('--clouds', nargs='+', default=default_clouds)
+    run_parser.add_argument('--scales', nargs='+', type=float, default=[0.5, 1, 4])
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('-o', '--output', default="bench_micro.json")
+    run_parser.add_argument('--compare', metavar='BASELINE', nargs='?', const=default_baseline,
+                            help="compare the run against this baseline (default: the checked-in one)")
+    compare_parser = commands.add_parser('compare', help="compare a run against a baseline")
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('baseline', nargs='?', default=default_baseline)
+    for command in (run_parser, compare_parser):
+        command.add_argument('--tolerance', type=float, default=0.25, help="allowed slow down, 0.25 = 25%%")
+        command.add_argument('--min-seconds', type=float, default=0.001,
+                             help="slow downs smaller than this are timer noise, not regressions")
+    args = parser.parse_args(argv)
+    baseline = args.baseline if args.command == 'compare' else args.compare
+    if baseline is not None and not os.path.isfile(baseline):
+        parser.error("baseline %s not found, save one with: python -m benchmarks.bench_micro run -o %s"
+                     % (baseline, baseline))
+
+    if args.command == 'compare':
+        return report(load(args.current), load(args.baseline), args.tolerance, args.min_seconds)
+
+    instrumentation.set_quiet(True)
+    with contextlib.redirect_stdout(sys.stderr):
+        rows = run(args.clouds, args.scales, args.repeat)
+    results = {'environment': environment(), 'scales': args.scales, 'repeat': args.repeat, 'rows': rows}
+    print("   %-56s %10s %10s %9s" % ("stage", "best", "median", "points"))
+    for row in rows:
+        if 'error' in row:
+            print("   %-56s %s" % (row_key(row), row['error']))
+        else:
+            print("   %-56s %8.2fms %8.2fms %9d" % (row_key(row), row['best'] * 1000, row['median'] * 1000,
+                                                    row['points']))
+    write_json(args.output, results)
+    if args.compare is not None:
+        return report(results, load(args.compare), args.tolerance, args.min_seconds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""Accuracy/latency of every local registration Method against a reference pose of the bundled source/target pair.
+
+benchmarks/reference_poses.json holds the pose the pair converges to: GICP refined from RANSAC starts of several
+seeds, kept only when the seeds agree (--build-reference recomputes it). Local registration starts from the
+reference moved by fixed perturbations (rotations about the source centroid, translations in voxel sizes) and from
+both global modes (RANSAC, FGR), and every result is compared against the reference.
+
+usage: python -m benchmarks.bench_registration [--source data/model.obj] [--target data/scene.obj] [--pyramid]
+                                               [--methods ...] [--starts ...] [-o bench_registration.json]
+       python -m benchmarks.bench_registration --build-reference [--seeds 6]
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+import numpy as np
+import open3d as o3d
+
+import globalregistration
+import localregistration
+import posestore
+import util
+from benchmarks.common import Measure, environment, write_json
+from localregistration import Method
+
+
+starts = ['perturbed', 'ransac', 'fgr']
+reference_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_poses.json")
+
+# (label, rotation axis, degrees, translation in voxel sizes), all inside the basin of the local methods
+perturbations = [
+    ('rx3', (1, 0, 0), 3, (0, 0, 0)),
+    ('ry5', (0, 1, 0), 5, (0, 0, 0)),
+    ('rz8', (0, 0, 1), 8, (0, 0, 0)),
+    ('t2', (0, 0, 1), 0, (2, 0, 0)),
+    ('t4', (0, 0, 1), 0, (0, -2, 3)),
+    ('rz5t3', (0, 0, 1), 5, (2, 2, 1)),
+]
+
+
+def pair_key(source, target):
+    return "%s -> %s" % (os.path.basename(source), os.path.basename(target))
+
+
+def load_reference(source, target, path=reference_path):
+    """Reference entry of the source/target pair, with its resultPose (row-major) as the 'pose' matrix."""
+    with open(path) as f:
+        references = json.load(f)
+    key = pair_key(source, target)
+    if key not in references:
+        raise KeyError("no reference pose for %s in %s, run with --build-reference" % (key, path))
+    reference = dict(references[key])
+    reference['pose'] = posestore.from_result_pose(reference['resultPose'])
+    return reference
+
+
+def perturbed_starts(reference_pose, source, voxel_size):
+    """(label, start pose) of every perturbation, rotating about the source centroid as placed by the reference."""
+    centroid = reference_pose[:3, :3] @ np.asarray(source.get_center()) + reference_pose[:3, 3]
+    poses = []
+    for label, axis, degrees, translation in perturbations:
+        rotation = o3d.geometry.get_rotation_matrix_from_axis_angle(np.radians(degrees) * np.asarray(axis, float))
+        move = np.eye(4)
+        move[:3, :3] = rotation
+        move[:3, 3] = centroid - rotation @ centroid + np.asarray(translation, float) * voxel_size
+        poses.append((label, move @ reference_pose))
+    return poses
+
+
+def build_reference(source, target, voxel_size, seeds, rotation_tolerance=0.5, translation_tolerance=None):
+    """GICP refined RANSAC poses of every seed; the best fitted pose of the largest agreeing group, if a majority."""
+    translation_tolerance = translation_tolerance or voxel_size
+    criteria = o3d.pipelines.registration.ICPConvergenceCriteria(1e-9, 1e-9, 200)
+    poses = []
+    for seed in range(seeds):
+        o3d.utility.random.seed(seed)
+        start = globalregistration.ransac_based_on_fpfh(source, target, voxel_size, False)
+        poses.append(np.asarray(localregistration.open3d_gicp(source, target, start, voxel_size, criteria)))
+
+    def agreeing(pose):
+        return [other for other in poses
+                if all(error <= tolerance for error, tolerance in
+                       zip(posestore.pose_difference(other, pose), (rotation_tolerance, translation_tolerance)))]
+
+    group = max((agreeing(pose) for pose in poses), key=len)
+    if 2 * len(group) <= seeds:
+        raise RuntimeError("only %d of %d seeds agree on a pose, no reference" % (len(group), seeds))
+    threshold = localregistration._distance_threshold(Method.OPEN3D_GREATEST, voxel_size)
+    evaluations = [o3d.pipelines.registration.evaluate_registration(source, target, threshold, pose)
+                   for pose in group]
+    best = int(np.argmax([evaluation.fitness for evaluation in evaluations]))
+    return {
+        'voxel_size': voxel_size,
+        'resultPose': posestore.to_result_pose(group[best]),
+        'fitness': evaluations[best].fitness,
+        'inlier_rmse': evaluations[best].inlier_rmse,
+        'method': "%s + %s" % ('ransac', Method.OPEN3D_GREATEST.name),
+        'seeds': seeds,
+        'agreeing_seeds': len(group),
+    }
+
+
+def global_start(start, source, target, voxel_size):
+    # cold features, so each global mode pays for its own FPFH extraction
+    globalregistration.featurecache.default_cache.clear()
+    with Measure() as measure:
+        pose = globalregistration.ransac_based_on_fpfh(source, target, voxel_size, start == 'fgr')
+    return np.asarray(pose), measure
+
+
+def count_iterations(method, source, target, start_pose, voxel_size):
+    """Iterations the method takes from start_pose, replayed by live_registration (None for OpenCV)."""
+    if method == Method.OPENCV:
+        return None
+    iterations = []
+    localregistration.live_registration(method, source, target, start_pose, voxel_size,
+                                        lambda iteration, pose, result: iterations.append(iteration))
+    return len(iterations)
+
+
+def run_case(label, start, method, source, target, voxel_size, start_pose, start_measure, reference, pyramid):
+    start_rotation_error, start_translation_error = posestore.pose_difference(start_pose, reference)
+    row = {'case': label, 'start': start, 'method': method.name, 'pyramid': pyramid,
+           'start_rotation_error_deg': start_rotation_error, 'start_translation_error': start_translation_error}
+    try:
+        with Measure() as measure:
+            pose = np.asarray(util.local_registration(source, target, start_pose, voxel_size, method, pyramid))
+    except Exception as e:
+        row['error'] = "%s: %s" % (type(e).__name__, e)
+        return row
+
+    evaluation = o3d.pipelines.registration.evaluate_registration(
+        source, target, localregistration._distance_threshold(method, voxel_size), pose)
+    rotation_error, translation_error = posestore.pose_difference(pose, reference)
+    row.update({
+        'global_seconds': start_measure.seconds if start_measure else 0.0,
+        'global_peak_memory': start_measure.peak_memory if start_measure else 0,
+        'local_seconds': measure.seconds,
+        'local_peak_memory': measure.peak_memory,
+        'iterations': None if pyramid else count_iterations(method, source, target, start_pose, voxel_size),
+        'fitness': evaluation.fitness,
+        'inlier_rmse': evaluation.inlier_rmse,
+        'rotation_error_deg': rotation_error,
+        'translation_error': translation_error,
+        'pose': pose.tolist(),
+    })
+    return row
+
+
+def summarize(rows):
+    print("   %-9s %-16s %8s %8s %9s %9s %7s %6s" % (
+        "start", "method", "global", "local", "peak MB", "rot deg", "trans mm", "iters"))
+    for start in starts:
+        for method in Method:
+            group = [r for r in rows if r['start'] == start and r['method'] == method.name and 'error' not in r]
+            if len(group) == 0:
+                continue
+            iterations = [r['iterations'] for r in group if r['iterations'] is not None]
+            print("   %-9s %-16s %7.3fs %7.3fs %9.1f %9.3f %7.2f %6s" % (
+                start, method.name,
+                np.mean([r['global_seconds'] for r in group]),
+                np.mean([r['local_seconds'] for r in group]),
+                max(max(r['global_peak_memory'], r['local_peak_memory']) for r in group) / 2 ** 20,
+                np.mean([r['rotation_error_deg'] for r in group]),
+                np.mean([r['translation_error'] for r in group]) * 1000,
+                "%.1f" % np.mean(iterations) if iterations else "-"))
+
+
+def write_reference(source_path, target_path, reference, path=reference_path):
+    references = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            references = json.load(f)
+    references[pair_key(source_path, target_path)] = reference
+    write_json(path, references)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default="data/model.obj")
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--methods', nargs='+', choices=[m.name for m in Method], default=[m.name for m in Method])
+    parser.add_argument('--starts', nargs='+', choices=starts, default=starts)
+    parser.add_argument('--pyramid', action='store_true', help="coarse-to-fine local registration")
+    parser.add_argument('--build-reference', action='store_true',
+                        help="recompute the reference pose of the pair and store it in %s" % reference_path)
+    parser.add_argument('--voxel-size', type=float, default=0.005, help="with --build-reference")
+    parser.add_argument('--seeds', type=int, default=6, help="RANSAC seeds that must agree, with --build-reference")
+    parser.add_argument('-o', '--output', default="bench_registration.json")
+    args = parser.parse_args(argv)
+
+    if args.build_reference:
+        with contextlib.redirect_stdout(sys.stderr):
+            source = util.process_pcd(util.load_cloud(args.source), args.voxel_size)
+            target = util.process_pcd(util.load_cloud(args.target), args.voxel_size)
+            reference = build_reference(source, target, args.voxel_size, args.seeds)
+        print(":: %d of %d seeds agree, fitness %.4f, inlier rmse %.6f" % (
+            reference['agreeing_seeds'], args.seeds, reference['fitness'], reference['inlier_rmse']))
+        write_reference(args.source, args.target, reference)
+        return
+
+    reference = load_reference(args.source, args.target)
+    voxel_size = reference['voxel_size']
+    rows = []
+    # keep the per-stage prints of the pipeline out of the report
+    with contextlib.redirect_stdout(sys.stderr):
+        source = util.process_pcd(util.load_cloud(args.source), voxel_size)
+        target = util.process_pcd(util.load_cloud(args.target), voxel_size)
+
+        for start in args.starts:
+            if start == 'perturbed':
+                cases, start_measure = perturbed_starts(reference['pose'], source, voxel_size), None
+            else:
+                start_pose, start_measure = global_start(start, source, target, voxel_size)
+                cases = [(start, start_pose)]
+            for label, start_pose in cases:
+                for name in args.methods:
+                    rows.append(run_case(label, start, Method[name], source, target, voxel_size, start_pose,
+                                         start_measure, reference['pose'], args.pyramid))
+
+    print(":: %s, %d starts x %d methods" % (pair_key(args.source, args.target), len(rows) // len(args.methods),
+                                             len(args.methods)))
+    summarize(rows)
+    write_json(args.output, {
+        'environment': environment(),
+        'source': args.source,
+        'target': args.target,
+        'voxel_size': voxel_size,
+        'reference': {key: value for key, value in reference.items() if key != 'pose'},
+        'source_points': len(source.points),
+        'target_points': len(target.points),
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Batched pose scoring against one evaluate_registration call per pose.
+
+A RANSAC pose is perturbed into --poses hypotheses (random rotations and translations of a few voxel sizes), which
+are scored by the Open3D loop, by PoseScorer on the grid and exactly, and ranked by PoseScorer.rank. The report shows
+the time of each and how far their fitness and ranking are from the Open3D reference.
+
+usage: python -m benchmarks.bench_scoring [--source data/model.obj] [--target data/scene.obj] [--poses 300]
+                                          [-o bench_scoring.json]
+"""
+import argparse
+import contextlib
+import sys
+
+import numpy as np
+import open3d as o3d
+
+import globalregistration
+import util
+from benchmarks.common import Measure, environment, write_json
+from posescoring import PoseScorer
+
+
+def perturbed_poses(pose, count, voxel_size, seed=0):
+    rng = np.random.default_rng(seed)
+    poses = np.tile(np.asarray(pose), (count, 1, 1))
+    for i in range(1, count):
+        rotation = o3d.geometry.get_rotation_matrix_from_axis_angle(rng.normal(0, 0.05, 3))
+        poses[i, :3, :3] = rotation @ poses[i, :3, :3]
+        poses[i, :3, 3] += rng.normal(0, voxel_size, 3)
+    return poses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default="data/model.obj")
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--poses', type=int, default=300)
+    parser.add_argument('-o', '--output', default="bench_scoring.json")
+    args = parser.parse_args(argv)
+
+    distance_threshold = args.voxel_size * 1.5
+    with contextlib.redirect_stdout(sys.stderr):
+        source = util.process_pcd(util.load_pcd(args.source), args.voxel_size)
+        target = util.process_pcd(util.load_pcd(args.target), args.voxel_size)
+        pose = globalregistration.ransac_based_on_fpfh(source, target, args.voxel_size, False)
+    poses = perturbed_poses(pose, args.poses, args.voxel_size)
+
+    with Measure() as measure:
+        reference = [o3d.pipelines.registration.evaluate_registration(source, target, distance_threshold, p)
+                     for p in poses]
+    reference_fitness = np.array([e.fitness for e in reference])
+    reference_order = np.lexsort((np.array([e.inlier_rmse for e in reference]), -reference_fitness))
+    rows = [{'mode': 'evaluate_registration', 'seconds': measure.seconds}]
+
+    with Measure() as measure:
+        scorer = PoseScorer(target, distance_threshold)
+        scorer._build_grid()
+    index_seconds = measure.seconds
+
+    for mode, exact in (('grid', False), ('exact', True)):
+        with Measure() as measure:
+            scores = scorer.score(source, poses, exact=exact)
+        rows.append({'mode': mode, 'seconds': measure.seconds,
+                     'max_fitness_error': float(np.abs(scores['fitness'] - reference_fitness).max())})
+
+    with Measure() as measure:
+        order, scores = scorer.rank(source, poses)
+    rows.append({'mode': 'rank', 'seconds': measure.seconds,
+                 'top5_agreement': len(set(order[:5]) & set(reference_order[:5])) / 5})
+
+    print("   %d poses x %d points, index built in %.3fs" % (len(poses), len(source.points), index_seconds))
+    print("   %-22s %9s %8s %14s" % ("mode", "seconds", "speedup", "vs reference"))
+    for row in rows:
+        if 'max_fitness_error' in row:
+            accuracy = "fitness err %.4f" % row['max_fitness_error']
+        elif 'top5_agreement' in row:
+            accuracy = "top-5 %d%%" % (100 * row['top5_agreement'])
+        else:
+            accuracy = ""
+        print("   %-22s %8.3fs %7.1fx %14s" % (row['mode'], row['seconds'], rows[0]['seconds'] / row['seconds'],
+                                                accuracy))
+
+    write_json(args.output, {
+        'environment': environment(),
+        'source': args.source,
+        'target': args.target,
+        'voxel_size': args.voxel_size,
+        'poses': len(poses),
+        'index_seconds': index_seconds,
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
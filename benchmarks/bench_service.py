@@ -0,0 +1,155 @@
+"""Local registration throughput: one process per registration against the warm registration service.
+
+The one-shot path starts a Python process that imports the pipeline, loads and processes the target and the source
+and runs local registration, as a script calling util would. The service path starts registrationservice.py once,
+prepares the target and sends the same registration --requests times through registrationclient, with the raw
+source in shared memory (service) and with an already down sampled source (service_processed). Every request starts
+from the first perturbed start of benchmarks/bench_registration (the pair's reference pose, moved).
+
+usage: python -m benchmarks.bench_service [--source data/model.obj] [--target data/scene.obj] [--one-shot 5]
+                                          [--requests 100] [--clients 1] [-o bench_service.json]
+"""
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.common import environment, write_json
+from registrationclient import RegistrationClient, ServiceError
+
+
+def one_shot(source, target, voxel_size, initial):
+    # what a single registration costs without the service, run in a fresh process
+    import util
+    with contextlib.redirect_stdout(sys.stderr):
+        target_pcd = util.process_pcd(util.load_cloud(target), voxel_size, target)
+        source_pcd = util.process_pcd(util.load_cloud(source), voxel_size)
+        return util.local_registration(source_pcd, target_pcd, initial, voxel_size)
+
+
+def run_one_shot(args, initial, count):
+    code = ("import numpy as np; from benchmarks.bench_service import one_shot; "
+            "one_shot(%r, %r, %r, np.array(%r))" % (args.source, args.target, args.voxel_size, initial.tolist()))
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def wait_for(socket_path, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("registration service exited with %d" % process.returncode)
+        try:
+            with RegistrationClient(socket_path) as client:
+                return client.ping()
+        except (ConnectionError, FileNotFoundError):
+            time.sleep(0.05)
+    raise RuntimeError("registration service did not start within %d sec" % timeout)
+
+
+def run_clients(socket_path, args, points, normals, initial, processed):
+    """Send args.requests registrations from args.clients connections, returns the latencies and the wall time."""
+    latencies = []
+    lock = threading.Lock()
+    per_client = [args.requests // args.clients + (i < args.requests % args.clients) for i in range(args.clients)]
+
+    def client_loop(count):
+        with RegistrationClient(socket_path) as client:
+            for _ in range(count):
+                start = time.perf_counter()
+                client.register(args.target, points, normals, initial, args.voxel_size, processed=processed)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client_loop, args=(count,)) for count in per_client]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def summary(mode, latencies, wall_seconds):
+    latencies = np.asarray(latencies)
+    return {'mode': mode, 'requests': len(latencies), 'requests_per_second': len(latencies) / wall_seconds,
+            'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+            'mean': float(latencies.mean())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--source', default="data/model.obj")
+    parser.add_argument('--target', default="data/scene.obj")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--one-shot', type=int, default=5, help="one-shot registrations (one process each)")
+    parser.add_argument('--requests', type=int, default=100, help="service requests per mode")
+    parser.add_argument('--clients', type=int, default=1, help="concurrent client connections")
+    parser.add_argument('-o', '--output', default="bench_service.json")
+    args = parser.parse_args(argv)
+
+    # the pipeline is only imported here for the source arrays, the clients themselves do not need it
+    import util
+    from benchmarks.bench_registration import load_reference, perturbed_starts
+    with contextlib.redirect_stdout(sys.stderr):
+        raw = util.load_cloud(args.source)
+        processed = util.process_pcd(raw, args.voxel_size)
+    initial = perturbed_starts(load_reference(args.source, args.target)['pose'], processed, args.voxel_size)[0][1]
+
+    rows = []
+    latencies = run_one_shot(args, initial, args.one_shot)
+    rows.append(summary('one_shot', latencies, sum(latencies)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, 'service.sock')
+        process = subprocess.Popen([sys.executable, 'registrationservice.py', '--socket', socket_path, '--quiet'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            start = time.perf_counter()
+            wait_for(socket_path, process)
+            with RegistrationClient(socket_path) as client:
+                client.load_target(args.target, args.voxel_size)
+            startup_seconds = time.perf_counter() - start
+
+            for mode, points, normals, is_processed in (
+                    ('service', raw.points, raw.normals, False),
+                    ('service_processed', np.asarray(processed.points), np.asarray(processed.normals), True)):
+                latencies, wall_seconds = run_clients(socket_path, args, points, normals, initial, is_processed)
+                rows.append(summary(mode, latencies, wall_seconds))
+        finally:
+            try:
+                with RegistrationClient(socket_path) as client:
+                    client.shutdown()
+            except (ConnectionError, FileNotFoundError, ServiceError):
+                pass
+            process.wait(timeout=30)
+
+    print("   service startup (imports + target) %.3fs, %d clients" % (startup_seconds, args.clients))
+    print("   %-18s %9s %8s %9s %9s" % ("mode", "requests", "req/s", "p50", "p99"))
+    for row in rows:
+        print("   %-18s %9d %8.2f %8.4fs %8.4fs" % (row['mode'], row['requests'], row['requests_per_second'],
+                                                   row['p50'], row['p99']))
+
+    write_json(args.output, {
+        'environment': environment(),
+        'source': args.source,
+        'target': args.target,
+        'voxel_size': args.voxel_size,
+        'clients': args.clients,
+        'startup_seconds': startup_seconds,
+        'rows': rows,
+    })
+
+
+if __name__ == '__main__':
+    main()
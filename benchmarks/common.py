@@ -0,0 +1,40 @@
+import json
+import os
+import platform
+import time
+
+from instrumentation import reset_peak_rss, rss_bytes, peak_rss_bytes
+
+
+class Measure:
+    """Wall time and peak memory growth of a with-block."""
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.rss_before = rss_bytes() or peak_rss_bytes() or 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.peak_memory = max(0, (peak_rss_bytes() or 0) - self.rss_before)
+        return False
+
+
+def environment():
+    import numpy
+    import open3d
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': numpy.__version__,
+        'open3d': open3d.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    print(":: results written to %s" % path)
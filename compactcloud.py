@@ -0,0 +1,166 @@
+"""Compact point cloud container: float32 points and normals, uint8 colors.
+
+A multi-million point scan used to exist as Panda3D vertex data, float32 arrays read out of it and a float64 Open3D
+PointCloud (72 bytes per point with normals and colors) at once. CompactCloud keeps one copy at 27 bytes per point
+(zero when borrowed from a memory-mapped .npc file) and is the cloud the rest borrows from: the LOD display is built
+from its arrays, the OpenCV (N, 6) layout and Open3D clouds are made on demand, and voxel_down_sample runs on it in
+float32, so only the down sampled cloud is ever converted to float64.
+"""
+import numpy as np
+from panda3d.core import Geom
+
+import conversion
+from instrumentation import stage
+
+
+class CompactCloud:
+    __slots__ = ('points', 'normals', 'colors', 'name')
+
+    chunk_points = 2 ** 20  # points converted at a time, bounds the float64/int64 temporaries
+    dense_cells_per_point = 4  # voxel grids up to this many cells per point are grouped by lookup table, not sorting
+
+    def __init__(self, points, normals=None, colors=None, name='PointCloud'):
+        """colors are either uint8 or floats in [0, 1]. Arrays already of the right dtype are borrowed, not copied."""
+        self.points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+        self.normals = None if normals is None else np.asarray(normals, dtype=np.float32).reshape((-1, 3))
+        if colors is not None:
+            colors = np.asarray(colors)
+            if colors.dtype != np.uint8:
+                colors = np.rint(np.clip(colors[:, :3], 0, 1) * 255).astype(np.uint8)
+            colors = colors[:, :3]
+        self.colors = colors
+        self.name = name
+
+    @classmethod
+    def from_geom_node(cls, geom_node):
+        vertex_data = conversion._geom_vertex_data(geom_node)
+        colors = conversion.column_view(vertex_data, 'color')
+        if colors is None or colors.dtype != np.uint8:
+            colors = conversion.read_column(vertex_data, 'color')
+        else:
+            colors = colors[:, :3].copy()
+        return cls(conversion.read_column(vertex_data, 'vertex'), conversion.read_column(vertex_data, 'normal'),
+                   colors, geom_node.getName())
+
+    @classmethod
+    def from_pcd(cls, pcd):
+        return cls(*conversion.pcd_to_arrays(pcd))
+
+    @classmethod
+    def from_tensor_pcd(cls, pcd):
+        """Borrow the columns of an open3d.t.geometry.PointCloud (it keeps the dtypes of the file it was read from)."""
+        def column(*names):
+            for name in names:
+                if name in pcd.point:
+                    return pcd.point[name].numpy()
+            return None
+
+        return cls(column('positions', 'points'), column('normals'), column('colors'))
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.points, self.normals, self.colors) if a is not None)
+
+    def has_normals(self):
+        return self.normals is not None
+
+    def has_colors(self):
+        return self.colors is not None
+
+    def float_colors(self):
+        return None if self.colors is None else self.colors / np.float32(255)
+
+    def bounds(self):
+        # column by column, a reduction over axis 0 of an (N, 3) float32 array is an order of magnitude slower
+        return (np.array([self.points[:, axis].min() for axis in range(3)]),
+                np.array([self.points[:, axis].max() for axis in range(3)]))
+
+    def to_pcd(self):
+        """Open3D (float64) copy, meant for down sampled clouds."""
+        return conversion.arrays_to_pcd(self.points, self.normals, self.float_colors())
+
+    def to_geom_node(self, usage=Geom.UH_static):
+        return conversion.arrays_to_geom_node(self.points, self.normals, self.colors, usage)
+
+    def numpy_pc(self):
+        """The OpenCV (N, 3) or (N, 6) float32 layout."""
+        if self.normals is None:
+            return np.ascontiguousarray(self.points)
+        return np.hstack((self.points, self.normals))
+
+    def voxel_keys(self, voxel_size):
+        """int64 key of the voxel of every point, on the grid PointCloud.voxel_down_sample uses."""
+        return self._voxel_grid(voxel_size)[0]
+
+    def _voxel_grid(self, voxel_size):
+        # voxel indices as Open3D computes them (in float64), one chunk at a time, and the number of grid cells
+        low, high = self.bounds()
+        origin = low.astype(np.float64) - voxel_size / 2
+        shape = np.floor((high - origin) / voxel_size).astype(np.int64) + 1
+
+        keys = np.zeros(len(self), dtype=np.int64)
+        cells = np.empty(min(len(self), self.chunk_points))
+        for start in range(0, len(self), self.chunk_points):
+            chunk_keys = keys[start:start + self.chunk_points]
+            chunk_cells = cells[:len(chunk_keys)]
+            # axis by axis, in place: whole (N, 3) temporaries cost more than the arithmetic
+            for axis in range(3):
+                np.subtract(self.points[start:start + self.chunk_points, axis], origin[axis], out=chunk_cells)
+                chunk_cells /= voxel_size
+                np.floor(chunk_cells, out=chunk_cells)
+                chunk_keys *= shape[axis]
+                chunk_keys += chunk_cells.astype(np.int64)
+        return keys, int(np.prod(shape))
+
+    def _group(self, keys, cells):
+        """Voxel of every point (numbered in key order) and the point count of every voxel."""
+        if cells <= self.dense_cells_per_point * len(keys):
+            # a lookup table over the whole grid, no sorting
+            counts = np.bincount(keys, minlength=cells)
+            occupied = np.flatnonzero(counts)
+            lookup = np.zeros(cells, dtype=np.intp)
+            lookup[occupied] = np.arange(len(occupied))
+            return lookup[keys], counts[occupied]
+        # sorting the keys groups the points of every voxel
+        order = np.argsort(keys)
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        del keys
+        counts = np.diff(np.append(starts, len(order)))
+        inverse = np.empty(len(order), dtype=np.intp)
+        inverse[order] = np.repeat(np.arange(len(starts)), counts)
+        return inverse, counts
+
+    def voxel_count(self, voxel_size):
+        """Points voxel_down_sample(voxel_size) would leave, without building the down sampled cloud."""
+        if len(self) == 0:
+            return 0
+        keys, cells = self._voxel_grid(voxel_size)
+        if cells <= self.dense_cells_per_point * len(keys):
+            return int(np.count_nonzero(np.bincount(keys, minlength=cells)))
+        return len(np.unique(keys))
+
+    def voxel_down_sample(self, voxel_size):
+        """Average the points (and colors, normals) of every voxel, like PointCloud.voxel_down_sample."""
+        with stage('downsample', points_in=len(self), voxel_size=voxel_size) as record:
+            if len(self) == 0:
+                return CompactCloud(self.points, self.normals, self.colors, self.name)
+            inverse, counts = self._group(*self._voxel_grid(voxel_size))
+
+            def average(column):
+                out = np.empty((len(counts), 3), dtype=np.float32)
+                for axis in range(3):
+                    out[:, axis] = np.bincount(inverse, weights=column[:, axis], minlength=len(counts)) / counts
+                return out
+
+            normals = None
+            if self.normals is not None:
+                normals = average(self.normals)
+                lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+                normals /= np.where(lengths > 0, lengths, 1)
+            colors = None if self.colors is None else np.rint(average(self.colors)).astype(np.uint8)
+            record['points_out'] = len(counts)
+            return CompactCloud(average(self.points), normals, colors, self.name)
@@ -0,0 +1,193 @@
+import open3d as o3d
+import numpy as np
+from panda3d.core import *
+
+from instrumentation import stage
+
+
+# numeric types we can view straight out of the vertex buffer
+_numpy_types = {
+    Geom.NT_float32: np.float32,
+    Geom.NT_float64: np.float64,
+    Geom.NT_uint8: np.uint8,
+}
+
+
+def _geom_vertex_data(geom_node):
+    return geom_node.node().getGeom(0).getVertexData()
+
+
+def column_view(vertex_data, name, writable=False):
+    """Return an (N, components) numpy view of one vertex column, or None if it can not be viewed in place.
+
+    The view borrows the Panda3D array memory, so it is only valid until the vertex data is modified again.
+    """
+    _format = vertex_data.getFormat()
+    internal_name = InternalName.make(name)
+    if not _format.hasColumn(internal_name):
+        return None
+
+    column = _format.getColumn(internal_name)
+    dtype = _numpy_types.get(column.getNumericType())
+    if dtype is None:
+        return None
+
+    array_index = _format.getArrayWith(internal_name)
+    stride = _format.getArray(array_index).getStride()
+    if writable:
+        array = vertex_data.modifyArray(array_index)
+    else:
+        array = vertex_data.getArray(array_index)
+
+    num_rows = vertex_data.getNumRows()
+    buffer = np.frombuffer(memoryview(array), dtype=np.uint8)[:num_rows * stride].reshape(num_rows, stride)
+    start = column.getStart()
+    width = column.getNumComponents() * column.getComponentBytes()
+    return buffer[:, start:start + width].view(dtype)
+
+
+def _read_column_rows(vertex_data, name):
+    # slow path for packed or otherwise unusual column types
+    rows = []
+    reader = GeomVertexReader(vertex_data, name)
+    while not reader.isAtEnd():
+        rows.append(tuple(reader.getData3()))
+    return np.array(rows, dtype=np.float32).reshape((-1, 3))
+
+
+def read_column(vertex_data, name):
+    """Copy the first three components of a vertex column into a float array ((N, 3), colors in [0, 1])."""
+    if not vertex_data.getFormat().hasColumn(InternalName.make(name)):
+        return None
+
+    view = column_view(vertex_data, name)
+    if view is None:
+        return _read_column_rows(vertex_data, name)
+
+    view = view[:, :3]
+    if view.dtype == np.uint8:
+        return view.astype(np.float32) / 255.0
+    return np.array(view, dtype=np.float32)
+
+
+def geom_node_to_arrays(geom_node):
+    vertex_data = _geom_vertex_data(geom_node)
+    points = read_column(vertex_data, 'vertex')
+    normals = read_column(vertex_data, 'normal')
+    colors = read_column(vertex_data, 'color')
+    return points, normals, colors
+
+
+def arrays_to_geom_node(points, normals=None, colors=None, usage=Geom.UH_static):
+    num_of_vertex = len(points)
+
+    _format = GeomVertexFormat.getV3n3c4()
+    vertex_data = GeomVertexData('pc', _format, usage)
+    vertex_data.uncleanSetNumRows(num_of_vertex)
+
+    column_view(vertex_data, 'vertex', writable=True)[:] = points
+    normal = column_view(vertex_data, 'normal', writable=True)
+    if normals is not None and len(normals) == num_of_vertex:
+        normal[:] = normals
+    else:
+        normal[:] = 0
+    if colors is None or len(colors) != num_of_vertex:
+        colors = np.ones((num_of_vertex, 3), dtype=np.float32)
+    write_colors(vertex_data, colors)
+
+    prim = GeomPoints(Geom.UH_static)
+    prim.add_next_vertices(num_of_vertex)
+    geom = Geom(vertex_data)
+    geom.addPrimitive(prim)
+
+    node = GeomNode('PointCloud')
+    node.addGeom(geom)
+    node = NodePath(node)
+    return node
+
+
+def write_colors(vertex_data, colors):
+    """Write RGB colors (floats in [0, 1] or uint8) to the color column in place (alpha is set to opaque)."""
+    colors = np.asarray(colors)
+    color = column_view(vertex_data, 'color', writable=True)
+    if color is None:
+        if colors.dtype == np.uint8:
+            colors = colors / 255.0
+        writer = GeomVertexWriter(vertex_data, 'color')
+        for c in colors:
+            writer.setData4(c[0], c[1], c[2], 1)
+        return
+
+    if colors.dtype == np.uint8:
+        color[:, :3] = colors[:, :3] if color.dtype == np.uint8 else colors[:, :3] / np.float32(255)
+    elif color.dtype == np.uint8:
+        color[:, :3] = np.rint(np.clip(colors, 0, 1) * 255)
+    else:
+        color[:, :3] = colors
+    color[:, 3] = 255 if color.dtype == np.uint8 else 1
+
+
+def geom_node_to_pcd(geom_node):
+    with stage('conversion', direction='geom_node_to_pcd') as record:
+        points, normals, colors = geom_node_to_arrays(geom_node)
+        record['points_in'] = record['points_out'] = len(points)
+        return arrays_to_pcd(points, normals, colors)
+
+
+def arrays_to_pcd(points, normals=None, colors=None):
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64))
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(np.asarray(normals, dtype=np.float64))
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64))
+    return pcd
+
+
+def pcd_to_arrays(pcd):
+    points = np.asarray(pcd.points)
+    normals = np.asarray(pcd.normals) if pcd.has_normals() else None
+    colors = np.asarray(pcd.colors) if pcd.has_colors() else None
+    return points, normals, colors
+
+
+def pcd_to_geom_node(pcd):
+    with stage('conversion', direction='pcd_to_geom_node', points_in=len(pcd.points)) as record:
+        points, normals, colors = pcd_to_arrays(pcd)
+        record['points_out'] = len(points)
+        return arrays_to_geom_node(points, normals, colors, Geom.UHDynamic)
+
+
+def mesh_node_to_point_cloud_node(source_node):
+    points, normals, colors = geom_node_to_arrays(source_node)
+    return arrays_to_geom_node(points, normals, colors)
+
+
+def geom_node_to_numpy_pc(geom_node):
+    vertex_data = _geom_vertex_data(geom_node)
+    points = read_column(vertex_data, 'vertex')
+    normals = read_column(vertex_data, 'normal')
+    if normals is None or len(normals) == 0:
+        return np.ascontiguousarray(points, dtype=np.float32)
+    return np.hstack((points, normals)).astype(np.float32)
+
+
+def as_pcd(cloud):
+    """Accept a point cloud GeomNode, an Open3D PointCloud or a compactcloud.CompactCloud."""
+    if isinstance(cloud, o3d.geometry.PointCloud):
+        return cloud
+    if isinstance(cloud, NodePath):
+        return geom_node_to_pcd(cloud)
+    return cloud.to_pcd()
+
+
+def as_numpy_pc(cloud):
+    """Accept the clouds as_pcd does, return the OpenCV (N, 6) layout."""
+    if isinstance(cloud, NodePath):
+        return geom_node_to_numpy_pc(cloud)
+    if not isinstance(cloud, o3d.geometry.PointCloud):
+        return cloud.numpy_pc()
+    points, normals, _ = pcd_to_arrays(cloud)
+    if normals is None:
+        return np.ascontiguousarray(points, dtype=np.float32)
+    return np.hstack((points, normals)).astype(np.float32)
@@ -0,0 +1,197 @@
+"""One source registered to many targets, or many sources to one target.
+
+The shared side is loaded, processed and gets its FPFH features once, in the calling process. Every pool worker
+receives it once when it starts (not with every pair): the worker seeds its feature cache with the features and, when
+the shared side is the target, builds the TargetIndex local registration reuses. Pairs then only pay for their own
+side (load, process, FPFH) and for global and local registration. Results come back in completion order, as the
+result lines of batch.py plus the pair index.
+
+usage: python fanout.py source.obj target.obj [target.obj ...] [--many-to-one] [-o results.jsonl] [-j workers]
+                        [--voxel-size 0.005] [--fast] [--multi-hypothesis] [--budget seconds]
+                        [--source-filter none] [--target-filter none] [--method OPEN3D_GREATEST] [--pyramid]
+                        [--stages stages.jsonl] [--quiet]
+
+The first file is the shared side: the source, or with --many-to-one the target (the other files are then sources).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import open3d as o3d
+
+import batch
+import featurecache
+import filtering
+import globalregistration
+import instrumentation
+import util
+from compactcloud import CompactCloud
+from conversion import arrays_to_pcd, as_pcd, pcd_to_arrays
+from instrumentation import log, stage
+from localregistration import Method, TargetIndex
+
+
+default_voxel_size = 0.005
+
+_shared = None  # in a worker: {'role', 'pcd', 'index'}, set by _init_worker
+
+
+def prepare_shared(cloud, voxel_size, filepath=None, filters=None):
+    """Processed cloud and FPFH features of the shared side, as arrays for the workers.
+
+    cloud is a model file or a raw cloud (CompactCloud, Open3D PointCloud, NodePath).
+    """
+    if isinstance(cloud, str):
+        filepath = cloud
+        cloud = util.load_cloud(cloud)
+    with stage('fanout_shared', file=None if filepath is None else os.path.basename(filepath)) as record:
+        pcd = util.process_pcd(cloud, voxel_size, filepath, filters=filters)
+        # computed through a cache of its own, whose only entry gives the key the workers' caches need
+        cache = featurecache.FeatureCache(max_entries=1)
+        globalregistration.fpfh(pcd, voxel_size, cache)
+        (key, feature), = cache.entries.items()
+        record['points_out'] = len(pcd.points)
+    return {'arrays': pcd_to_arrays(pcd), 'fpfh_key': key, 'fpfh': np.asarray(feature.data)}
+
+
+def _init_worker(shared, role, voxel_size, stages_path=None, quiet=False):
+    global _shared
+    sys.stdout = sys.stderr  # keep the pipeline's progress prints off stdout, which may carry the JSON lines
+    instrumentation.set_quiet(quiet)
+    instrumentation.clear_sinks()  # forked workers inherit the sinks of the calling process
+    if stages_path is not None:
+        instrumentation.add_sink(instrumentation.JsonLinesSink(stages_path))
+
+    pcd = arrays_to_pcd(*shared['arrays'])
+    feature = o3d.pipelines.registration.Feature()
+    feature.data = shared['fpfh']
+    featurecache.default_cache.put(shared['fpfh_key'], feature)
+    _shared = {'role': role, 'pcd': pcd, 'index': TargetIndex(pcd, voxel_size) if role == 'target' else None}
+
+
+def register_pair(job):
+    index, other, voxel_size, fast, multi_hypothesis, budget, method, pyramid, other_filter = job
+    role = _shared['role']
+    other_path = other if isinstance(other, str) else None
+    result = {'index': index, 'voxel_size': voxel_size, 'fast': fast, 'multi_hypothesis': multi_hypothesis,
+              'budget': budget, 'method': method.name, 'pyramid': pyramid, 'shared': role,
+              ('target' if role == 'source' else 'source'): other_path}
+
+    def prepare(result, timings):
+        # only the other side is loaded and processed, the shared one comes from _init_worker
+        start = time.perf_counter()
+        cloud = util.load_cloud(other) if other_path is not None else other
+        timings['load'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pcd = util.process_pcd(cloud, voxel_size, other_path, filters=filtering.presets[other_filter])
+        timings['process'] = time.perf_counter() - start
+
+        if role == 'source':
+            return _shared['pcd'], pcd, pcd, voxel_size
+        return pcd, _shared['pcd'], _shared['index'], voxel_size
+
+    return batch.register(result, prepare, fast, multi_hypothesis, budget, method, pyramid)
+
+
+def _picklable(cloud):
+    # Open3D clouds and Panda3D nodes do not pickle, they travel to the workers as CompactClouds
+    if isinstance(cloud, (str, CompactCloud)):
+        return cloud
+    return CompactCloud.from_pcd(as_pcd(cloud))
+
+
+def run(shared, others, voxel_size=default_voxel_size, shared_role='source', fast=False, multi_hypothesis=False,
+        method=Method.OPEN3D_GREATEST, pyramid=False, workers=None, budget=None, stages_path=None, quiet=False,
+        filters=('none', 'none')):
+    """Register the shared cloud against every one of others, yield a result dict per pair in completion order.
+
+    shared_role is 'source' (one source to many targets) or 'target' (many sources to one target). shared and others
+    are model files or raw clouds; in-memory others are pickled to the workers, files are loaded there. filters are
+    the (source, target) filtering.presets names.
+    """
+    if shared_role not in ('source', 'target'):
+        raise ValueError("shared_role must be 'source' or 'target', not %r" % shared_role)
+    source_filter, target_filter = filters
+    shared_filter, other_filter = (source_filter, target_filter) if shared_role == 'source' else \
+        (target_filter, source_filter)
+
+    start = time.perf_counter()
+    prepared = prepare_shared(shared, voxel_size, filters=filtering.presets[shared_filter])
+    log(":: Shared %s prepared in %.3f sec (%d points), %d pairs."
+        % (shared_role, time.perf_counter() - start, len(prepared['arrays'][0]), len(others)))
+
+    jobs = [(index, _picklable(other), voxel_size, fast, multi_hypothesis, budget, method, pyramid, other_filter)
+            for index, other in enumerate(others)]
+    workers = min(workers or os.cpu_count(), max(1, len(jobs)))
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(prepared, shared_role, voxel_size, stages_path, quiet)) as pool:
+        for result in pool.imap_unordered(register_pair, jobs):
+            yield result
+
+
+def register_one_to_many(source, targets, voxel_size=default_voxel_size, **options):
+    """Results of registering source to every target, in the order of targets (see run for the options)."""
+    return sorted(run(source, targets, voxel_size, 'source', **options), key=lambda result: result['index'])
+
+
+def register_many_to_one(sources, target, voxel_size=default_voxel_size, **options):
+    """Results of registering every source to target, in the order of sources (see run for the options)."""
+    return sorted(run(target, sources, voxel_size, 'target', **options), key=lambda result: result['index'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register one source to many targets or many sources to one target.")
+    parser.add_argument('shared', help="the source, or the target with --many-to-one")
+    parser.add_argument('others', nargs='+', help="the targets, or the sources with --many-to-one")
+    parser.add_argument('--many-to-one', action='store_true', help="the first file is the target")
+    parser.add_argument('-o', '--output', help="JSON lines output file (default: stdout)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--voxel-size', type=float, default=default_voxel_size)
+    parser.add_argument('--fast', action='store_true', help="use FGR instead of RANSAC for global registration")
+    parser.add_argument('--multi-hypothesis', action='store_true',
+                        help="rank several RANSAC/FGR hypotheses instead of trusting a single run")
+    parser.add_argument('--budget', type=float,
+                        help="time budget in seconds for global registration (anytime RANSAC, best pose so far)")
+    parser.add_argument('--source-filter', choices=filtering.presets, default='none')
+    parser.add_argument('--target-filter', choices=filtering.presets, default='none')
+    parser.add_argument('--stages', help="append per-stage instrumentation records (JSON lines) to this file")
+    parser.add_argument('--quiet', action='store_true', help="no pipeline progress messages")
+    parser.add_argument('--method', choices=[m.name for m in Method], default=Method.OPEN3D_GREATEST.name)
+    parser.add_argument('--pyramid', action='store_true', help="coarse-to-fine local registration")
+    args = parser.parse_args(argv)
+
+    instrumentation.set_quiet(args.quiet)
+    if args.stages is not None:
+        instrumentation.add_sink(instrumentation.JsonLinesSink(args.stages))
+    output = open(args.output, 'w') if args.output else sys.stdout
+    failed = 0
+    start = time.perf_counter()
+    try:
+        stdout, sys.stdout = sys.stdout, sys.stderr  # the shared side's progress prints stay off the JSON lines
+        try:
+            results = run(os.path.abspath(args.shared), [os.path.abspath(other) for other in args.others],
+                          args.voxel_size, 'target' if args.many_to_one else 'source', args.fast,
+                          args.multi_hypothesis, Method[args.method], args.pyramid, args.workers, args.budget,
+                          args.stages, args.quiet, (args.source_filter, args.target_filter))
+            for result in results:
+                failed += 'error' in result
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            sys.stdout = stdout
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(":: registered %d pairs in %.3f sec, %d failed." % (len(args.others), time.perf_counter() - start, failed),
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
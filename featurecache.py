@@ -0,0 +1,143 @@
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import open3d as o3d
+
+
+def cloud_hash(pcd):
+    """Content hash of the points and normals of a point cloud (FPFH depends on both)."""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(np.asarray(pcd.points)).tobytes())
+    if pcd.has_normals():
+        h.update(np.ascontiguousarray(np.asarray(pcd.normals)).tobytes())
+    return h.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU of at most max_entries values.
+
+    For whatever else is kept by key (trained PPF detectors, processed service targets). lock guards entries, callers
+    holding it may read entries directly.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()  # registrations may run on worker threads
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class FeatureCache(LRUCache):
+    """FPFH features keyed by cloud content and feature parameters.
+
+    Features are kept in an in-memory LRU and, if cache_dir is given, also written to cache_dir as .npz files
+    so they survive restarts.
+    """
+
+    def __init__(self, max_entries=16, cache_dir=None):
+        super().__init__(max_entries)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(pcd, voxel_size, radius, max_nn):
+        return "%s_%g_%g_%d" % (cloud_hash(pcd), voxel_size, radius, max_nn)
+
+    def get(self, key):
+        with self.lock:
+            feature = self.entries.get(key)
+            if feature is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return feature
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as npz:
+                    data = npz['data']
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):  # unreadable, recomputed
+                data = None
+            if data is not None:
+                feature = o3d.pipelines.registration.Feature()
+                feature.data = data
+                super().put(key, feature)
+                with self.lock:
+                    self.disk_hits += 1
+                return feature
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, feature):
+        super().put(key, feature)
+        path = self._path(key)
+        if path is not None:
+            # write then rename, so pool workers sharing cache_dir never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, data=np.asarray(feature.data))
+            os.replace(tmp_path, path)
+
+    def get_or_compute(self, pcd, voxel_size, radius, max_nn, compute):
+        key = self.key(pcd, voxel_size, radius, max_nn)
+        feature = self.get(key)
+        if feature is None:
+            feature = compute()
+            self.put(key, feature)
+        return feature
+
+    def clear(self):
+        super().clear()
+        self.disk_hits = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + ".npz")
+
+
+# shared by every global registration in the process
+default_cache = FeatureCache()
@@ -0,0 +1,61 @@
+"""Noise filtering, step 1 of the pipeline: runs on the raw cloud before down_sampling.
+
+Distances are given in voxel sizes, so the same settings work for scans of any scale.
+"""
+from typing import NamedTuple
+
+import open3d as o3d
+
+from instrumentation import log, stage
+
+
+class FilterSettings(NamedTuple):
+    statistical_neighbors: int = 20  # 0 disables statistical outlier removal
+    statistical_std_ratio: float = 2.0
+    radius_points: int = 0  # 0 disables radius outlier removal
+    radius: float = 2.0  # in voxel sizes
+    remove_plane: bool = False  # drop the dominant plane (table, floor), e.g. the background of a scene
+    plane_distance: float = 1.0  # in voxel sizes
+    min_plane_fraction: float = 0.2  # a plane smaller than this fraction of the points is kept
+    plane_iterations: int = 1000
+
+
+presets = {
+    'none': None,
+    'outliers': FilterSettings(),
+    'background': FilterSettings(remove_plane=True),
+}
+
+
+def filter_pcd(pcd, voxel_size, settings=None):
+    """Returns the filtered cloud and a report of the points removed by every step."""
+    if settings is None:
+        settings = FilterSettings()
+    report = {'points_in': len(pcd.points)}
+
+    with stage('filter', points_in=len(pcd.points)) as record:
+        if settings.statistical_neighbors > 0:
+            pcd, _ = pcd.remove_statistical_outlier(settings.statistical_neighbors, settings.statistical_std_ratio)
+            report['statistical'] = report['points_in'] - len(pcd.points)
+
+        if settings.radius_points > 0:
+            count = len(pcd.points)
+            pcd, _ = pcd.remove_radius_outlier(settings.radius_points, settings.radius * voxel_size)
+            report['radius'] = count - len(pcd.points)
+
+        if settings.remove_plane and len(pcd.points) >= 3:
+            _, inliers = pcd.segment_plane(settings.plane_distance * voxel_size, 3, settings.plane_iterations)
+            if len(inliers) >= settings.min_plane_fraction * len(pcd.points):
+                pcd = pcd.select_by_index(inliers, invert=True)
+                report['plane'] = len(inliers)
+            else:
+                report['plane'] = 0
+
+        report['points_out'] = len(pcd.points)
+        report['removed'] = report['points_in'] - report['points_out']
+        record.update(report)
+
+    log(":: Filtering removed %d of %d points (%s)."
+        % (report['removed'], report['points_in'],
+           ", ".join("%s %d" % (name, report[name]) for name in ('statistical', 'radius', 'plane') if name in report)))
+    return pcd, report
@@ -1,37 +1,362 @@
+import atexit
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import numpy as np
 import open3d as o3d
 
+import featurecache
+from conversion import as_numpy_pc
+from instrumentation import log, stage
+from posescoring import PoseScorer
+
+
+def fpfh(pcd, voxel_size, cache=None):
+    if cache is None:
+        cache = featurecache.default_cache
 
-def fpfh(pcd, voxel_size):
     radius_feature = voxel_size * 5
-    print(":: Compute FPFH feature with search radius %.3f." % radius_feature)
-    pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        pcd,
-        o3d.geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=100))
-    return pcd_fpfh
+    max_nn = 100
 
+    def compute():
+        log(":: Compute FPFH feature with search radius %.3f." % radius_feature)
+        with stage('fpfh', points_in=len(pcd.points)):
+            return o3d.pipelines.registration.compute_fpfh_feature(
+                pcd,
+                o3d.geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=max_nn))
 
-def ransac_based_on_fpfh(source, target, voxel_size, fast):
-    distance_threshold = voxel_size * 1.5
-    print(":: RANSAC registration on downsampled point clouds.")
-    print("   Since the downsampling voxel size is %.3f," % voxel_size)
-    print("   we use a liberal distance threshold %.3f." % distance_threshold)
-    print("   option fast: %d" % fast)
+    return cache.get_or_compute(pcd, voxel_size, radius_feature, max_nn, compute)
 
-    if not fast:
+
+def _record_result(record, result):
+    record['fitness'] = result.fitness
+    record['inlier_rmse'] = result.inlier_rmse
+
+
+def _ransac_checkers(distance_threshold):
+    return [
+        o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(
+            0.9),
+        o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
+            distance_threshold)
+    ]
+
+
+def ransac(source, target, source_fpfh, target_fpfh, distance_threshold, mutual_filter=True, criteria=None):
+    criteria = criteria or o3d.pipelines.registration.RANSACConvergenceCriteria(100000, 0.999)
+    # max_iteration is an upper bound, RANSAC stops earlier once the confidence is reached
+    with stage('ransac', points_in=len(source.points), max_iteration=criteria.max_iteration) as record:
         result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-            source, target, fpfh(source, voxel_size), fpfh(target, voxel_size), True,
+            source, target, source_fpfh, target_fpfh, mutual_filter,
             distance_threshold,
             o3d.pipelines.registration.TransformationEstimationPointToPoint(False),
-            3, [
-                o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(
-                    0.9),
-                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(
-                    distance_threshold)
-            ], o3d.pipelines.registration.RANSACConvergenceCriteria(100000, 0.999))
-    else:
+            3, _ransac_checkers(distance_threshold), criteria)
+        _record_result(record, result)
+    return result
+
+
+def fgr(source, target, source_fpfh, target_fpfh, distance_threshold):
+    option = o3d.pipelines.registration.FastGlobalRegistrationOption(
+        maximum_correspondence_distance=distance_threshold)
+    with stage('fgr', points_in=len(source.points), max_iteration=option.iteration_number) as record:
         result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
-            source, target, fpfh(source, voxel_size), fpfh(target, voxel_size),
-            o3d.pipelines.registration.FastGlobalRegistrationOption(
-                maximum_correspondence_distance=distance_threshold))
-    print(result)
-    return result.transformation
\ No newline at end of file
+            source, target, source_fpfh, target_fpfh, option)
+        _record_result(record, result)
+    return result
+
+
+def ransac_based_on_fpfh(source, target, voxel_size, fast, cache=None):
+    distance_threshold = voxel_size * 1.5
+    log(":: RANSAC registration on downsampled point clouds.")
+    log("   Since the downsampling voxel size is %.3f," % voxel_size)
+    log("   we use a liberal distance threshold %.3f." % distance_threshold)
+    log("   option fast: %d" % fast)
+
+    source_fpfh = fpfh(source, voxel_size, cache)
+    target_fpfh = fpfh(target, voxel_size, cache)
+
+    if not fast:
+        result = ransac(source, target, source_fpfh, target_fpfh, distance_threshold)
+    else:
+        result = fgr(source, target, source_fpfh, target_fpfh, distance_threshold)
+    log(result)
+    return result.transformation
+
+
+# trained PPF detectors, keyed by model content and training parameters
+ppf_cache = featurecache.LRUCache(max_entries=4)
+
+
+def ppf_detector(model, relative_sampling_step=0.07, relative_distance_step=0.05, cache=None):
+    """PPF surface matching detector trained on model (with normals), reused for every scene it is matched against.
+
+    Training is quadratic in the sampled model points, which is why it is cached. OpenCV can not serialize a trained
+    detector (no pickle, read/write are not bound), so trained detectors live as long as the process.
+    """
+    if cache is None:
+        cache = ppf_cache
+    key = "ppf_%s_%g_%g" % (featurecache.cloud_hash(model), relative_sampling_step, relative_distance_step)
+    detector = cache.get(key)
+    if detector is None:
+        log(":: Train PPF model with sampling step %.3f of the model diameter." % relative_sampling_step)
+        with stage('ppf_train', points_in=len(model.points)):
+            detector = cv.ppf_match_3d_PPF3DDetector(relative_sampling_step, relative_distance_step)
+            detector.trainModel(as_numpy_pc(model))
+        cache.put(key, detector)
+    return detector
+
+
+def ppf(source, target, voxel_size, relative_scene_sample_step=1.0 / 40, relative_scene_distance=0.05,
+        candidates=5, cache=None, **training):
+    """Global registration by PPF surface matching, the source is the trained model and the target the scene.
+
+    The best voted poses are rescored with the same evaluation as the other global registrations.
+    """
+    distance_threshold = voxel_size * 1.5
+    detector = ppf_detector(source, cache=cache, **training)
+    log(":: PPF matching, every %d-th scene point is a reference point." % round(1 / relative_scene_sample_step))
+    with stage('ppf_match', points_in=len(target.points)) as record:
+        poses = detector.match(as_numpy_pc(target), relative_scene_sample_step, relative_scene_distance)
+        best = None
+        for pose in poses[:candidates]:
+            evaluation = o3d.pipelines.registration.evaluate_registration(source, target, distance_threshold,
+                                                                          pose.pose)
+            if best is None or evaluation.fitness > best[0].fitness:
+                best = (evaluation, np.asarray(pose.pose))
+        if best is None:
+            log("   no PPF pose found.")
+            return np.identity(4)
+        _record_result(record, best[0])
+    log("   fitness %.4f, inlier rmse %.5f" % (best[0].fitness, best[0].inlier_rmse))
+    return best[1]
+
+
+def default_hypotheses(count=None):
+    """RANSAC with different seeds, with and without the mutual filter, plus one FGR."""
+    if count is None:
+        count = max(2, os.cpu_count() or 1)
+    hypotheses = [{'method': 'fgr'}]
+    seed = 0
+    while len(hypotheses) < count:
+        hypotheses.append({'method': 'ransac', 'seed': seed, 'mutual_filter': seed % 2 == 0})
+        seed += 1
+    return hypotheses
+
+
+_executor = None
+
+
+def _get_executor():
+    # kept alive between calls, so only the first multi-hypothesis registration pays for starting the workers
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(_shutdown_executor)
+    return _executor
+
+
+def _shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+def _to_pcd(points, normals):
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
+def _to_feature(data):
+    feature = o3d.pipelines.registration.Feature()
+    feature.data = data
+    return feature
+
+
+def _run_hypothesis(hypothesis, source, target, source_fpfh, target_fpfh, distance_threshold):
+    start = time.perf_counter()
+    if hypothesis['method'] == 'fgr':
+        result = fgr(source, target, source_fpfh, target_fpfh, distance_threshold)
+    else:
+        result = ransac(source, target, source_fpfh, target_fpfh, distance_threshold,
+                        hypothesis.get('mutual_filter', True))
+    return np.asarray(result.transformation), time.perf_counter() - start
+
+
+def _run_hypothesis_in_worker(hypothesis, clouds, distance_threshold):
+    # Open3D objects do not pickle, the clouds and features travel as arrays
+    source_points, source_normals, source_data, target_points, target_normals, target_data = clouds
+    if 'seed' in hypothesis:
+        o3d.utility.random.seed(hypothesis['seed'])  # the worker's own generator, the caller's is left alone
+    return _run_hypothesis(hypothesis,
+                           _to_pcd(source_points, source_normals), _to_pcd(target_points, target_normals),
+                           _to_feature(source_data), _to_feature(target_data), distance_threshold)
+
+
+def multi_hypothesis(source, target, voxel_size, hypotheses=None, parallel=None, cache=None):
+    """Run several global registration hypotheses, score them in one batched evaluation and rank them.
+
+    Hypotheses run on a process pool unless parallel is False (by default they run in-process inside daemonic pool
+    workers, which can not start processes of their own). RANSAC seeds only apply on the pool: Open3D can not save
+    and restore its random state, so in-process hypotheses draw from the process-wide generator instead. Returns the
+    best transformation and the ranked candidates (dicts with the hypothesis, fitness, inlier_rmse, seconds and
+    transformation).
+    """
+    if hypotheses is None:
+        hypotheses = default_hypotheses()
+    if parallel is None:
+        parallel = not multiprocessing.current_process().daemon
+    distance_threshold = voxel_size * 1.5
+    log(":: %d global registration hypotheses, distance threshold %.3f." % (len(hypotheses), distance_threshold))
+
+    source_fpfh = fpfh(source, voxel_size, cache)
+    target_fpfh = fpfh(target, voxel_size, cache)
+
+    if parallel:
+        clouds = (np.asarray(source.points), np.asarray(source.normals), np.asarray(source_fpfh.data),
+                  np.asarray(target.points), np.asarray(target.normals), np.asarray(target_fpfh.data))
+        executor = _get_executor()
+        futures = [executor.submit(_run_hypothesis_in_worker, h, clouds, distance_threshold) for h in hypotheses]
+        outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [_run_hypothesis(h, source, target, source_fpfh, target_fpfh, distance_threshold)
+                    for h in hypotheses]
+
+    transformations = [np.asarray(transformation) for transformation, _ in outcomes]
+    scores = PoseScorer(target, distance_threshold).score(source, transformations, exact=True)
+    candidates = []
+    for i, (hypothesis, (transformation, seconds)) in enumerate(zip(hypotheses, outcomes)):
+        candidates.append({'hypothesis': hypothesis, 'fitness': float(scores['fitness'][i]),
+                           'inlier_rmse': float(scores['inlier_rmse'][i]), 'seconds': seconds,
+                           'transformation': transformation})
+    candidates.sort(key=lambda c: (-c['fitness'], c['inlier_rmse']))
+
+    for candidate in candidates:
+        log("   %-48s fitness %.4f, rmse %.5f, %.3f sec" % (candidate['hypothesis'], candidate['fitness'],
+                                                              candidate['inlier_rmse'], candidate['seconds']))
+    return candidates[0]['transformation'], candidates
+
+
+class AnytimeRegistration:
+    """RANSAC run in chunks under a wall-clock deadline.
+
+    The best transformation so far (with its fitness and inlier_rmse) is kept on the object after every chunk, so
+    another thread can read it at any point. The search stops at the deadline, or earlier once the best fitness has
+    not improved by more than plateau_tolerance for plateau_chunks chunks in a row.
+
+    The FPFH features are matched once (mutual nearest neighbours, as ransac() does on every call), the chunks only
+    run RANSAC on those correspondences. With a progress (jobs.Progress), setting progress.stopped cancels the
+    search before the next chunk; deadline may then be math.inf, the plateau or the cancel ends the search.
+
+    The budget includes the features and their matching, but the small first chunk always runs: a budget shorter
+    than the features still returns a RANSAC pose, just after the deadline. Open3D does not report how many
+    iterations RANSAC ran before its confidence was reached, requested_iterations counts the chunk sizes asked for.
+    """
+
+    def __init__(self, source, target, voxel_size, deadline, chunk_iterations=2000, plateau_chunks=3,
+                 plateau_tolerance=1e-3, first_chunk_iterations=200, cache=None, progress=None):
+        self.start_time = time.time()  # the budget includes the feature computation
+        self.source = source
+        self.target = target
+        self.distance_threshold = voxel_size * 1.5
+        self.source_fpfh = fpfh(source, voxel_size, cache)
+        self.target_fpfh = fpfh(target, voxel_size, cache)
+        with stage('fpfh_matching', points_in=len(source.points)) as record:
+            self.correspondences = o3d.pipelines.registration.correspondences_from_features(
+                self.source_fpfh, self.target_fpfh, True)
+            record['points_out'] = len(self.correspondences)
+
+        self.deadline = deadline  # time.time() value
+        self.chunk_iterations = chunk_iterations
+        self.first_chunk_iterations = first_chunk_iterations  # small, to time an iteration
+        self.plateau_chunks = plateau_chunks
+        self.plateau_tolerance = plateau_tolerance
+        self.progress = progress
+
+        self.transformation = np.identity(4)
+        self.fitness = 0.0
+        self.inlier_rmse = 0.0
+        self.requested_iterations = 0
+        self.chunks = 0
+        self.stop_reason = None
+        self.elapsed = 0.0
+
+    @property
+    def budget(self):
+        return self.deadline - self.start_time
+
+    @property
+    def budget_used(self):
+        """Fraction of the budget spent (can slightly exceed 1, a running chunk is never interrupted)."""
+        return self.elapsed / self.budget if self.budget > 0 else 1.0
+
+    def _chunk(self, iterations):
+        """RANSAC on the stored correspondences, and the seconds the registration call took."""
+        criteria = o3d.pipelines.registration.RANSACConvergenceCriteria(iterations, 0.999)
+        with stage('ransac', points_in=len(self.source.points), max_iteration=iterations) as record:
+            start = time.perf_counter()
+            result = o3d.pipelines.registration.registration_ransac_based_on_correspondence(
+                self.source, self.target, self.correspondences, self.distance_threshold,
+                o3d.pipelines.registration.TransformationEstimationPointToPoint(False),
+                3, _ransac_checkers(self.distance_threshold), criteria)
+            seconds = time.perf_counter() - start
+            _record_result(record, result)
+        return result, seconds
+
+    def run(self):
+        """The first chunk runs even past the deadline, so there is a result to return."""
+        budget = self.budget if math.isfinite(self.budget) else None
+        with stage('anytime_ransac', points_in=len(self.source.points), budget=budget) as record:
+            seconds_per_iteration = None
+            stale_chunks = 0
+
+            while True:
+                if self.progress is not None and self.progress.stopped:
+                    self.stop_reason = 'cancelled'
+                    break
+                remaining = self.deadline - time.time()
+                if seconds_per_iteration is not None and remaining < seconds_per_iteration * 100:
+                    self.stop_reason = 'deadline'
+                    break
+                if seconds_per_iteration is None:
+                    iterations = self.first_chunk_iterations
+                else:
+                    iterations = int(min(self.chunk_iterations, remaining / seconds_per_iteration))
+
+                result, seconds = self._chunk(iterations)
+                seconds_per_iteration = seconds / iterations
+                self.requested_iterations += iterations
+                self.chunks += 1
+
+                improvement = result.fitness - self.fitness
+                if improvement > 0 or (result.fitness == self.fitness and result.inlier_rmse < self.inlier_rmse):
+                    self.transformation = np.asarray(result.transformation)
+                    self.fitness = result.fitness
+                    self.inlier_rmse = result.inlier_rmse
+                self.elapsed = time.time() - self.start_time
+
+                stale_chunks = stale_chunks + 1 if improvement <= self.plateau_tolerance else 0
+                if stale_chunks >= self.plateau_chunks:
+                    self.stop_reason = 'plateau'
+                    break
+
+            self.elapsed = time.time() - self.start_time
+            record.update(requested_iterations=self.requested_iterations, chunks=self.chunks, stop_reason=self.stop_reason,
+                          budget_used=self.budget_used, fitness=self.fitness, inlier_rmse=self.inlier_rmse)
+
+        log(":: anytime RANSAC stopped (%s) after %d chunks (at most %d iterations), %.3f of %.3f sec budget used."
+            % (self.stop_reason, self.chunks, self.requested_iterations, self.elapsed, self.budget))
+        log("   fitness %.4f, inlier rmse %.5f" % (self.fitness, self.inlier_rmse))
+        return self
+
+
+def anytime_ransac(source, target, voxel_size, budget=None, deadline=None, cache=None, **options):
+    """Deadline-bounded RANSAC, pass a budget in seconds or an absolute time.time() deadline (neither: no deadline)."""
+    if deadline is None:
+        deadline = time.time() + budget if budget is not None else math.inf
+    return AnytimeRegistration(source, target, voxel_size, deadline, cache=cache, **options).run()
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""Per-stage instrumentation of the registration pipeline.
+
+Every pipeline stage (load, conversion, downsample, normals, fpfh, ransac/fgr, icp) runs inside stage():
+
+    with instrumentation.stage('downsample', points_in=len(pcd.points)) as record:
+        down = pcd.voxel_down_sample(voxel_size)
+        record['points_out'] = len(down.points)
+
+A finished record holds the stage name, its parent stage, duration (seconds), rss_growth (growth of the resident set
+size, sampled at the entry and exit of the stage and of its nested stages, Linux only; not a peak) and whatever the stage filled
+in: points_in, points_out, iterations, max_iteration, fitness, inlier_rmse. An outermost stage also reports peak_rss,
+the high-water mark of the process, which the pipeline never resets. Records go to every registered sink, a sink is
+any callable taking the record:
+
+    instrumentation.add_sink(instrumentation.JsonLinesSink('stages.jsonl'))
+    histograms = instrumentation.add_sink(instrumentation.HistogramSink())
+    instrumentation.profile_stage('fpfh', 'fpfh.prof')   # cProfile capture of one stage
+    instrumentation.set_quiet()                           # drop the pipeline's progress prints
+
+Without sinks and profiler a stage only costs a dict and a generator, nothing is measured.
+"""
+import cProfile
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+quiet = False
+
+_sinks = []
+_profiler = None
+_local = threading.local()  # stack of the open stages of the thread
+
+
+def set_quiet(value=True):
+    global quiet
+    quiet = value
+
+
+def log(*values):
+    """print() for the pipeline's progress messages, silent in quiet mode."""
+    if not quiet:
+        print(*values)
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def clear_sinks():
+    del _sinks[:]
+
+
+def _status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the whole process (Linux only, silently ignored elsewhere).
+
+    For benchmarks measuring one block at a time, stages never call it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rss_bytes():
+    kb = _status_kb('VmRSS')
+    return None if kb is None else kb * 1024
+
+
+def peak_rss_bytes():
+    """Peak resident set size of the process, None where it can not be read (Windows)."""
+    kb = _status_kb('VmHWM')
+    if kb is None:
+        try:
+            import resource  # Unix only
+        except ImportError:
+            return None
+        # ru_maxrss is kilobytes on linux but bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    return kb * 1024
+
+
+class _OpenStage:
+    def __init__(self, name):
+        self.name = name
+        self.rss = rss_bytes() or 0
+        self.peak = self.rss  # highest resident set size sampled so far, here and in nested stages
+
+
+@contextmanager
+def stage(name, **fields):
+    record = {'stage': name}
+    record.update(fields)
+    if not _sinks and _profiler is None:
+        yield record
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+
+    current = _OpenStage(name)
+    stack.append(current)
+    profiling = _profiler is not None and _profiler.stage == name and not _profiler.active
+    if profiling:
+        _profiler.start()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        if profiling:
+            _profiler.stop()
+        stack.pop()
+        current.peak = max(current.peak, rss_bytes() or 0)
+        if parent is not None:
+            parent.peak = max(parent.peak, current.peak)
+
+        record['parent'] = parent.name if parent is not None else None
+        record['duration'] = duration
+        record['rss_growth'] = current.peak - current.rss
+        if parent is None:
+            record['peak_rss'] = peak_rss_bytes()
+        for sink in list(_sinks):
+            sink(record)
+
+
+class JsonLinesSink:
+    """Writes one JSON line per finished stage to a file path or an open file."""
+
+    def __init__(self, output):
+        self.owned = isinstance(output, str)
+        self.file = open(output, 'a') if self.owned else output
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=_json_default) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class HistogramSink:
+    """Keeps the durations (and resident set size growth) of every stage in memory."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.rss_growth = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            self.durations[record['stage']].append(record['duration'])
+            self.rss_growth[record['stage']].append(record['rss_growth'])
+
+    def histogram(self, name, bins=10):
+        """numpy.histogram of the durations of one stage, (counts, bin edges)."""
+        return np.histogram(self.durations[name], bins=bins)
+
+    def summary(self):
+        summary = {}
+        for name, durations in self.durations.items():
+            durations = np.asarray(durations)
+            summary[name] = {
+                'count': len(durations),
+                'total': float(durations.sum()),
+                'mean': float(durations.mean()),
+                'p50': float(np.percentile(durations, 50)),
+                'p95': float(np.percentile(durations, 95)),
+                'max': float(durations.max()),
+                'rss_growth_max': int(max(self.rss_growth[name])),
+            }
+        return summary
+
+    def print_summary(self, file=None):
+        print(":: %-20s %6s %10s %10s %10s %10s %12s" % ('stage', 'count', 'total s', 'mean ms', 'p95 ms',
+                                                        'max ms', 'growth MiB'), file=file)
+        for name, s in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            print("   %-20s %6d %10.3f %10.2f %10.2f %10.2f %12.1f"
+                  % (name, s['count'], s['total'], s['mean'] * 1000, s['p95'] * 1000, s['max'] * 1000,
+                     s['rss_growth_max'] / 2 ** 20), file=file)
+
+
+class StageProfiler:
+    """cProfile capture of every run of one stage, dumped to path after each run if a path is given."""
+
+    def __init__(self, stage, path=None):
+        self.stage = stage
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.active = False
+
+    def start(self):
+        self.active = True
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.active = False
+        if self.path is not None:
+            self.profile.dump_stats(self.path)
+
+    def stats(self):
+        import pstats
+        return pstats.Stats(self.profile)
+
+
+def profile_stage(name, path=None):
+    """Profile the named stage (None stops profiling), returns the StageProfiler."""
+    global _profiler
+    _profiler = StageProfiler(name, path) if name is not None else None
+    return _profiler
@@ -0,0 +1,104 @@
+import threading
+import time
+import traceback
+
+
+class Progress:
+    """Latest intermediate result of a running job, handed from its worker thread to the display loop.
+
+    publish replaces a value the display has not taken yet, so the display only sees the newest one. wanted tells the
+    worker whether the display took the previous value, which throttles work done only for display to the frame rate.
+    stopped asks the worker to stop at its next step.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.taken = True
+        self.stopped = False
+
+    def wanted(self):
+        return self.taken
+
+    def publish(self, value):
+        with self.lock:
+            self.value = value
+            self.taken = False
+
+    def take(self):
+        """The value published since the last take, or None."""
+        with self.lock:
+            value = self.value
+            self.value = None
+            self.taken = True
+            return value
+
+
+class Job:
+    def __init__(self, job_id, name, func, args, progress=None):
+        self.id = job_id
+        self.name = name
+        self.func = func
+        self.args = args
+        self.progress = progress
+        self.start_time = time.time()
+        self.end_time = None
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def elapsed(self):
+        end = self.end_time if self.end_time is not None else time.time()
+        return end - self.start_time
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+        finally:
+            self.end_time = time.time()
+            self.finished.set()
+
+
+class JobRunner:
+    """Runs registration jobs on worker threads, one current job at a time.
+
+    Open3D releases the GIL while it registers, so the Panda3D/Tk loop keeps running. A running Open3D call can not
+    be interrupted: cancelling (or submitting a new job, which supersedes the current one) only detaches the job,
+    its thread finishes in the background and the result is dropped. Jobs given a Progress are also asked to stop
+    at their next step (live local registration between iterations, RANSAC between its chunks), so their thread does
+    not keep the CPU busy.
+    """
+
+    def __init__(self):
+        self.current = None
+        self.next_id = 0
+
+    def submit(self, name, func, *args, progress=None):
+        self.cancel()
+        job = Job(self.next_id, name, func, args, progress)
+        self.next_id += 1
+        self.current = job
+        threading.Thread(target=job.run, name="registration-%d" % job.id, daemon=True).start()
+        return job
+
+    def cancel(self):
+        if self.current is not None:
+            self.current.cancelled = True
+            if self.current.progress is not None:
+                self.current.progress.stopped = True
+            self.current = None
+
+    def busy(self):
+        return self.current is not None
+
+    def poll(self):
+        """Return the current job once it has finished (and forget it), otherwise None."""
+        job = self.current
+        if job is None or not job.finished.is_set():
+            return None
+        self.current = None
+        return job
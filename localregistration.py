@@ -2,8 +2,10 @@ import cv2 as cv
 import open3d as o3d
 import numpy as np
 
-import util
+from conversion import as_pcd, as_numpy_pc
+from instrumentation import log, stage
 from enum import Enum
+from typing import NamedTuple
 
 
 class Method(Enum):
@@ -13,47 +15,154 @@ class Method(Enum):
     OPEN3D_COLORED = 3
 
 
-def open3d_icp(source_node, target_node, initial_transformation, voxel_size):
-    source_pcd = util.geom_node_to_pcd(source_node)
-    target_pcd = util.geom_node_to_pcd(target_node)
+class PyramidLevel(NamedTuple):
+    scale: float  # voxel size of the level, relative to the registration voxel size
+    max_iteration: int
+    relative_fitness: float = 1e-6
+    relative_rmse: float = 1e-6
 
-    distance_threshold = voxel_size * 0.4
-    print(":: Point-to-plane ICP registration is applied on original point")
-    print("   clouds to refine the alignment. This time we use a strict")
-    print("   distance threshold %.3f." % distance_threshold)
-    result = o3d.pipelines.registration.registration_icp(
-        source_pcd, target_pcd, distance_threshold, initial_transformation,
-        o3d.pipelines.registration.TransformationEstimationPointToPlane())
-    print(result)
+
+class TargetIndex:
+    """Target side of local registration, prepared once per target and voxel size.
+
+    Every local registration method accepts it in place of the target node, so repeated refinements against the
+    same scene only pay for the source side. Coarser copies for pyramid registration are built on first use.
+    """
+
+    gicp_epsilon = 1e-3  # same plane regularization Open3D uses when it derives GICP covariances from normals
+
+    def __init__(self, target_node, voxel_size):
+        self.voxel_size = voxel_size
+        self.pcd = as_pcd(target_node)
+        if self.pcd is target_node:
+            self.pcd = o3d.geometry.PointCloud(self.pcd)  # normals and covariances are added below
+        if not self.pcd.has_normals():
+            self.pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+
+        normals = np.asarray(self.pcd.normals)
+        self.pcd.covariances = o3d.utility.Matrix3dVector(
+            np.eye(3) - (1 - self.gicp_epsilon) * normals[:, :, None] * normals[:, None, :])
+
+        self._numpy_pc = None
+        self._levels = {}
+
+    def numpy_pc(self):
+        if self._numpy_pc is None:
+            self._numpy_pc = as_numpy_pc(self.pcd)
+        return self._numpy_pc
+
+    def level(self, scale):
+        if scale <= 1:
+            return self
+        if scale not in self._levels:
+            self._levels[scale] = TargetIndex(_pyramid_level_pcd(self.pcd, self.voxel_size * scale),
+                                              self.voxel_size * scale)
+        return self._levels[scale]
+
+
+def _target_pcd(target):
+    if isinstance(target, TargetIndex):
+        return target.pcd
+    return as_pcd(target)
+
+
+def _record_result(record, result):
+    # Open3D does not report how many ICP iterations ran, only the max_iteration limit is recorded
+    record['fitness'] = result.fitness
+    record['inlier_rmse'] = result.inlier_rmse
+    record['correspondences'] = len(result.correspondence_set)
+
+
+# coarse to fine, most iterations happen on the coarse levels
+default_pyramid = [
+    PyramidLevel(4, 30, 1e-4, 1e-4),
+    PyramidLevel(2, 20, 1e-5, 1e-5),
+    PyramidLevel(1, 10),
+]
+
+
+def _distance_threshold(method, voxel_size):
+    return voxel_size if method == Method.OPEN3D_COLORED else voxel_size * 0.4
+
+
+def _default_criteria(method):
+    if method == Method.OPEN3D_COLORED:
+        return o3d.pipelines.registration.ICPConvergenceCriteria(relative_fitness=1e-6, relative_rmse=1e-6,
+                                                                 max_iteration=50)
+    return o3d.pipelines.registration.ICPConvergenceCriteria()
+
+
+def _register(method, source_pcd, target_pcd, initial_transformation, voxel_size, criteria):
+    # the Open3D call behind each Method, shared by the plain and the live registration
+    registration = o3d.pipelines.registration
+    distance_threshold = _distance_threshold(method, voxel_size)
+    if method == Method.OPEN3D_DEFAULT:
+        return registration.registration_icp(
+            source_pcd, target_pcd, distance_threshold, initial_transformation,
+            registration.TransformationEstimationPointToPlane(), criteria)
+    if method == Method.OPEN3D_GREATEST:
+        return registration.registration_generalized_icp(
+            source_pcd, target_pcd, distance_threshold, initial_transformation,
+            registration.TransformationEstimationForGeneralizedICP(), criteria)
+    if method == Method.OPEN3D_COLORED:
+        return registration.registration_colored_icp(
+            source_pcd, target_pcd, distance_threshold, initial_transformation,
+            registration.TransformationEstimationForColoredICP(
+                lambda_geometric=0.8  # default: 0.968000
+            ), criteria)
+    raise ValueError("%s is not an Open3D registration" % method.name)
+
+
+def open3d_icp(source_node, target_node, initial_transformation, voxel_size, criteria=None):
+    source_pcd = as_pcd(source_node)
+    target_pcd = _target_pcd(target_node)
+
+    distance_threshold = _distance_threshold(Method.OPEN3D_DEFAULT, voxel_size)
+    log(":: Point-to-plane ICP registration is applied on original point")
+    log("   clouds to refine the alignment. This time we use a strict")
+    log("   distance threshold %.3f." % distance_threshold)
+    criteria = criteria or _default_criteria(Method.OPEN3D_DEFAULT)
+    with stage('icp', method='point_to_plane', points_in=len(source_pcd.points),
+               max_iteration=criteria.max_iteration) as record:
+        result = _register(Method.OPEN3D_DEFAULT, source_pcd, target_pcd, initial_transformation, voxel_size,
+                           criteria)
+        _record_result(record, result)
+    log(result)
     return result.transformation
 
 
-def open3d_gicp(source_node, target_node, initial_transformation, voxel_size):
-    source_pcd = util.geom_node_to_pcd(source_node)
-    target_pcd = util.geom_node_to_pcd(target_node)
+def open3d_gicp(source_node, target_node, initial_transformation, voxel_size, criteria=None):
+    source_pcd = as_pcd(source_node)
+    target_pcd = _target_pcd(target_node)
 
-    distance_threshold = voxel_size * 0.4
-    print(":: gicp registration is applied on original point")
-    print("   clouds to refine the alignment. This time we use a strict")
-    print("   distance threshold %.3f." % distance_threshold)
-    result = o3d.pipelines.registration.registration_generalized_icp(
-        source_pcd, target_pcd, distance_threshold, initial_transformation,
-        o3d.pipelines.registration.TransformationEstimationForGeneralizedICP())
-    print(result)
+    distance_threshold = _distance_threshold(Method.OPEN3D_GREATEST, voxel_size)
+    log(":: gicp registration is applied on original point")
+    log("   clouds to refine the alignment. This time we use a strict")
+    log("   distance threshold %.3f." % distance_threshold)
+    criteria = criteria or _default_criteria(Method.OPEN3D_GREATEST)
+    with stage('icp', method='gicp', points_in=len(source_pcd.points),
+               max_iteration=criteria.max_iteration) as record:
+        result = _register(Method.OPEN3D_GREATEST, source_pcd, target_pcd, initial_transformation, voxel_size,
+                           criteria)
+        _record_result(record, result)
+    log(result)
     return result.transformation
 
 
 def opencv_icp(source_node, target_node, initial_transformation):
-    source_pc = util.geom_node_to_numpy_pc(source_node)
-    target_pc = util.geom_node_to_numpy_pc(target_node)
+    source_pc = as_numpy_pc(source_node)
+    if isinstance(target_node, TargetIndex):
+        target_pc = target_node.numpy_pc()
+    else:
+        target_pc = as_numpy_pc(target_node)
 
     iterations: int = 100
     tolerence: float = 0.005
     rejectionScale: float = 2.5
     numLevels: int = 8
 
-    print(":: opencv icp registration is applied on original point")
-    print("   clouds to refine the alignment. This time we use a strict")
+    log(":: opencv icp registration is applied on original point")
+    log("   clouds to refine the alignment. This time we use a strict")
     icp = cv.ppf_match_3d_ICP(iterations=iterations
                               , tolerence=tolerence
                               , rejectionScale=rejectionScale
@@ -64,8 +173,10 @@ def opencv_icp(source_node, target_node, initial_transformation):
     pose3d = cv.ppf_match_3d_Pose3D()
     pose3d.updatePose(np.array(initial_transformation))
 
-    retval, poses = icp.registerModelToScene(source_pc, target_pc, [pose3d])
-    print("   residual: %.6f." % poses[0].residual)
+    with stage('icp', method='opencv', points_in=len(source_pc), max_iteration=iterations) as record:
+        retval, poses = icp.registerModelToScene(source_pc, target_pc, [pose3d])
+        record['residual'] = poses[0].residual
+    log("   residual: %.6f." % poses[0].residual)
 
     if poses[0].residual > 1.0:
         return np.eye(4)
@@ -73,22 +184,101 @@ def opencv_icp(source_node, target_node, initial_transformation):
     return poses[0].pose
 
 
-def colored_icp(source_node, target_node, initial_transformation, voxel_size):
-    source_pcd = util.geom_node_to_pcd(source_node)
-    target_pcd = util.geom_node_to_pcd(target_node)
+def colored_icp(source_node, target_node, initial_transformation, voxel_size, criteria=None):
+    source_pcd = as_pcd(source_node)
+    target_pcd = _target_pcd(target_node)
 
-    print(":: colored icp registration is applied on original point")
-    print("   clouds to refine the alignment. This time we use a strict")
-    print("   radius threshold %.3f." % voxel_size)
+    log(":: colored icp registration is applied on original point")
+    log("   clouds to refine the alignment. This time we use a strict")
+    log("   radius threshold %.3f." % voxel_size)
 
-    result = o3d.pipelines.registration.registration_colored_icp(
-        source_pcd, target_pcd, voxel_size, initial_transformation,
-        o3d.pipelines.registration.TransformationEstimationForColoredICP(
-            lambda_geometric=0.8  # default: 0.968000
-        ),
-        o3d.pipelines.registration.ICPConvergenceCriteria(relative_fitness=1e-6,
-                                                          relative_rmse=1e-6,
-                                                          max_iteration=50))
-    print(result)
+    criteria = criteria or _default_criteria(Method.OPEN3D_COLORED)
+    with stage('icp', method='colored', points_in=len(source_pcd.points),
+               max_iteration=criteria.max_iteration) as record:
+        result = _register(Method.OPEN3D_COLORED, source_pcd, target_pcd, initial_transformation, voxel_size,
+                           criteria)
+        _record_result(record, result)
+    log(result)
 
     return result.transformation
+
+
+def _pyramid_level_pcd(pcd, level_voxel_size):
+    level_pcd = pcd.voxel_down_sample(level_voxel_size)
+    level_pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=level_voxel_size * 2, max_nn=30))
+    return level_pcd
+
+
+def pyramid_registration(method, source_node, target_node, initial_transformation, voxel_size, levels=None):
+    """Coarse-to-fine refinement, each level starts from the pose of the previous one.
+
+    Distance thresholds follow the level voxel size, so they shrink toward the finest level.
+    """
+    refine = {
+        Method.OPEN3D_DEFAULT: open3d_icp,
+        Method.OPEN3D_GREATEST: open3d_gicp,
+        Method.OPEN3D_COLORED: colored_icp,
+    }[method]
+    if levels is None:
+        levels = default_pyramid
+
+    source_pcd = as_pcd(source_node)
+    target_index = target_node
+    if not isinstance(target_index, TargetIndex) or target_index.voxel_size != voxel_size:
+        target_index = TargetIndex(_target_pcd(target_node), voxel_size)
+
+    pose = np.asarray(initial_transformation)
+    with stage('pyramid', method=method.name, points_in=len(source_pcd.points), levels=len(levels)):
+        for level in levels:
+            level_voxel_size = voxel_size * level.scale
+            level_target = target_index.level(level.scale)
+            if level.scale > 1:
+                level_source = _pyramid_level_pcd(source_pcd, level_voxel_size)
+            else:
+                level_source = source_pcd
+            log(":: pyramid level x%g: %d source / %d target points."
+                % (level.scale, len(level_source.points), len(level_target.pcd.points)))
+
+            criteria = o3d.pipelines.registration.ICPConvergenceCriteria(
+                relative_fitness=level.relative_fitness, relative_rmse=level.relative_rmse,
+                max_iteration=level.max_iteration)
+            pose = refine(level_source, level_target, pose, level_voxel_size, criteria)
+    return pose
+
+
+def live_registration(method, source_node, target_node, initial_transformation, voxel_size, callback,
+                      criteria=None):
+    """Open3D local registration one iteration at a time, callback(iteration, transformation, result) after each.
+
+    Every step is a max_iteration=1 run started from the previous pose, and the convergence test of the full run
+    (relative fitness and RMSE change) is applied between the steps, so the poses are the ones the plain method goes
+    through. Each step rebuilds the target search tree, a live run is slower than a plain one. callback returning
+    False stops the registration at the current pose.
+    """
+    source_pcd = as_pcd(source_node)
+    target_pcd = _target_pcd(target_node)
+    criteria = criteria or _default_criteria(method)
+    step = o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=1)
+
+    pose = np.asarray(initial_transformation)
+    log(":: live %s registration, at most %d iterations." % (method.name, criteria.max_iteration))
+    with stage('icp', method=method.name, live=True, points_in=len(source_pcd.points),
+               max_iteration=criteria.max_iteration) as record:
+        previous = o3d.pipelines.registration.evaluate_registration(
+            source_pcd, target_pcd, _distance_threshold(method, voxel_size), pose)
+        result = previous
+        iteration = 0
+        while iteration < criteria.max_iteration:
+            result = _register(method, source_pcd, target_pcd, pose, voxel_size, step)
+            pose = result.transformation
+            iteration += 1
+            if callback(iteration, pose, result) is False:
+                break
+            if abs(previous.fitness - result.fitness) < criteria.relative_fitness and \
+                    abs(previous.inlier_rmse - result.inlier_rmse) < criteria.relative_rmse:
+                break
+            previous = result
+        _record_result(record, result)
+        record['iterations'] = iteration
+    log(result)
+    return pose
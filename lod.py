@@ -0,0 +1,114 @@
+"""Level-of-detail point cloud display for large scans.
+
+The points are split into an octree of chunk GeomNodes, so Panda3D culls every chunk (and every octree cell above it)
+outside the view frustum. Each chunk stores its points in a random order, which makes any prefix of its vertices a
+uniform subsample: showing fewer points is only a shorter GeomPoints primitive over the same vertex data.
+
+While the camera moves every chunk shows a coarse prefix (moving_points in total), once it is idle the visible chunks
+are refined back to all their points, nearest first and a few per frame.
+"""
+import numpy as np
+from panda3d.core import *
+
+import conversion
+
+
+class LodPointCloud:
+    def __init__(self, points, normals=None, colors=None, leaf_points=32768, moving_points=200000, max_depth=8,
+                 name='PointCloud'):
+        points = np.asarray(points, dtype=np.float32)
+        order = np.random.default_rng(0).permutation(len(points))
+        points = points[order]
+        normals = None if normals is None else np.asarray(normals)[order]
+        colors = None if colors is None else np.asarray(colors)[order]
+
+        self.root = NodePath(name)
+        self.leaf_points = leaf_points
+        self.max_depth = max_depth
+        self.chunks = []  # (chunk NodePath, point count, center)
+        self.shown = []  # points currently drawn per chunk
+        self.total_points = len(points)
+        self.coarse_fraction = min(1.0, moving_points / max(len(points), 1))
+        self.refined = True  # visible chunks are complete, nothing to do until the camera moves again
+
+        if len(points) > 0:
+            self._build(self.root, points, normals, colors, np.arange(len(points)), 0)
+
+    @classmethod
+    def from_geom_node(cls, geom_node, **options):
+        points, normals, colors = conversion.geom_node_to_arrays(geom_node)
+        return cls(points, normals, colors, **options)
+
+    @classmethod
+    def from_cloud(cls, cloud, **options):
+        """Build from a CompactCloud (uint8 colors are written to the chunks as they are)."""
+        return cls(cloud.points, cloud.normals, cloud.colors, name=cloud.name, **options)
+
+    def _build(self, parent, points, normals, colors, indices, depth):
+        cell_points = points[indices]
+        if len(indices) <= self.leaf_points or depth >= self.max_depth:
+            # indices stay sorted, so the chunk keeps the random order of the whole cloud
+            chunk = conversion.arrays_to_geom_node(cell_points,
+                                                   None if normals is None else normals[indices],
+                                                   None if colors is None else colors[indices])
+            chunk.node().setName('chunk')
+            chunk.reparentTo(parent)
+            center = (cell_points.min(axis=0) + cell_points.max(axis=0)) / 2
+            self.chunks.append((chunk, len(indices), Point3(*center)))
+            self.shown.append(len(indices))
+            return
+
+        center = (cell_points.min(axis=0) + cell_points.max(axis=0)) / 2
+        octant = ((cell_points > center) * np.array([1, 2, 4])).sum(axis=1)
+        cell = parent.attachNewNode('cell')
+        for i in range(8):
+            child_indices = indices[octant == i]
+            if len(child_indices) > 0:
+                self._build(cell, points, normals, colors, child_indices, depth + 1)
+
+    def _show(self, i, count):
+        chunk, size, _ = self.chunks[i]
+        count = max(1, min(size, count))
+        if self.shown[i] == count:
+            return 0
+        prim = GeomPoints(Geom.UH_static)
+        prim.addConsecutiveVertices(0, count)
+        chunk.node().modifyGeom(0).setPrimitive(0, prim)
+        added = count - self.shown[i]
+        self.shown[i] = count
+        return added
+
+    def coarsen(self):
+        """Show the moving subset in every chunk, cheap to call every frame while the camera moves."""
+        if self.coarse_fraction >= 1.0:
+            return
+        for i, (_, size, _) in enumerate(self.chunks):
+            self._show(i, int(np.ceil(size * self.coarse_fraction)))
+        self.refined = False
+
+    def refine(self, camera, max_points=500000):
+        """Add up to max_points points to the visible chunks, nearest first. Returns True once they are complete."""
+        if self.refined:
+            return True
+        lens_bounds = camera.node().getLens().makeBounds()
+        lens_bounds.xform(camera.getMat(self.root))
+        camera_pos = camera.getPos(self.root)
+
+        pending = []
+        for i, (chunk, size, center) in enumerate(self.chunks):
+            if self.shown[i] < size and lens_bounds.contains(chunk.getBounds()) != BoundingVolume.IF_no_intersection:
+                pending.append(((center - camera_pos).lengthSquared(), i))
+
+        budget = max_points
+        for _, i in sorted(pending):
+            if budget <= 0:
+                return False
+            budget -= self._show(i, self.shown[i] + budget)
+        self.refined = True
+        return True
+
+    def shown_points(self):
+        return sum(self.shown)
+
+    def removeNode(self):
+        self.root.removeNode()
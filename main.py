@@ -1,10 +1,20 @@
+import functools
 import os.path
 import tkinter.filedialog
 from direct.gui.DirectButton import DirectButton
 from direct.gui.DirectLabel import DirectLabel
 from panda3d.core import *
+import numpy as np
 
+import posestore
 import util
+from compactcloud import CompactCloud
+from conversion import read_column, write_colors
+from filtering import FilterSettings
+from jobs import JobRunner, Progress
+from lod import LodPointCloud
+from localregistration import Method, TargetIndex
+from posescoring import PoseScorer
 
 from direct.showbase.ShowBase import ShowBase
 
@@ -12,6 +22,19 @@ from direct.showbase.ShowBase import ShowBase
 default_source_path = "data/model.obj"
 default_target_path = "data/scene.obj"
 voxel_size = 0.005  # sampling 단위
+# noise filtering before down sampling, None: no filtering
+source_filters = None
+target_filters = FilterSettings()
+# raw point clouds are drawn through an octree LOD: a coarse subset while the camera moves, refined when idle
+lod_moving_points = 200000  # points per cloud drawn while the camera moves
+lod_idle_delay = 0.2  # seconds without camera movement before refining
+lod_refine_points = 500000  # points added per frame while refining
+file_types = [("Model", "*.obj *.npc"), ("All files", "*")]
+# live local registration: the source moves every ICP iteration (at most once per frame), optionally colored by
+# its distance to the target, green (0) to red (residual_color_distance)
+live_icp = True
+live_residual_colors = True
+residual_color_distance = voxel_size
 
 
 class App(ShowBase):
@@ -25,15 +48,16 @@ class App(ShowBase):
         self.source_parent_node.reparentTo(self.render)
 
         self.source_mesh_node = None
-        self.source_pc_node = None
+        self.source_pc_lod = None
         self.source_processed_pc_node = None
 
         self.target_parent_node = NodePath("target_parent")
         self.target_parent_node.reparentTo(self.render)
 
         self.target_mesh_node = None
-        self.target_pc_node = None
+        self.target_pc_lod = None
         self.target_processed_pc_node = None
+        self.target_index = None
 
         self.source_pc_view = None
         self.source_processed_pc_view = None
@@ -42,6 +66,12 @@ class App(ShowBase):
         self.registration_view = None
         self.ui_view = None
 
+        self.jobs = JobRunner()
+        self.job_label = None
+        self.live = None  # Progress of a live local registration
+        self.live_status = ""
+        self.source_colors = None  # colors of the processed source while residual colors replace them
+
         self.start_tk()
 
         frame = self.tkRoot
@@ -62,9 +92,15 @@ class App(ShowBase):
         self.filtered_pc_view_var = tkinter.IntVar(value=1)
         view_menu.add_checkbutton(label="Filtered Point Cloud", command=self.switch_source_processed_pc
                                   , variable=self.filtered_pc_view_var)
+        view_menu.add_separator()
+        self.live_icp_var = tkinter.IntVar(value=int(live_icp))
+        view_menu.add_checkbutton(label="Live ICP", variable=self.live_icp_var)
+        self.residual_colors_var = tkinter.IntVar(value=int(live_residual_colors))
+        view_menu.add_checkbutton(label="Residual Colors", variable=self.residual_colors_var)
         registration_menu = tkinter.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Registration", menu=registration_menu)
         registration_menu.add_command(label="set source transform", command=self.set_source_transform)
+        registration_menu.add_command(label="best stored pose", command=self.warm_start)
 
         frame.config(menu=menu_bar)
         frame.update()
@@ -89,6 +125,8 @@ class App(ShowBase):
 
 
         self.__set_camera()
+        self.taskMgr.add(self.update_job, 'Registration Job')
+        self.taskMgr.add(self.update_lod, 'Point Cloud LOD')
 
         self.load_source(default_source_path)
         self.load_target(default_target_path)
@@ -124,6 +162,8 @@ class App(ShowBase):
         self.accept('mouse1-up', self.wheel_up)
         self.lastMousePos = None
         self.wheel_pressed = False
+        self.view_changed = False
+        self.last_view_change = 0
         self.taskMgr.add(self.rotate_view, 'Rotate Camera View', extraArgs=[], appendTask=True)
 
 
@@ -227,14 +267,19 @@ class App(ShowBase):
                      text_scale=0.1, pos=(0, 0, 0), command=self.global_registration)
         DirectButton(text=["local registration"], parent=aspect2d, frameSize=(-.5, .5, -.05, .1),
                      text_scale=0.1, pos=(0, 0, -0.2), command=self.local_registration)
+        DirectButton(text=["cancel"], parent=aspect2d, frameSize=(-.5, .5, -.05, .1),
+                     text_scale=0.1, pos=(0, 0, -0.4), command=self.cancel_registration)
+        self.job_label = DirectLabel(text="", text_font=font, text_scale=0.08, parent=aspect2d,
+                                     frameSize=(-1, 1, -.1, .1), pos=(0, 0, -0.6))
 
     def load_source(self, filepath):
-        filepath = os.path.abspath(filepath)
-        filepath = Filename.fromOsSpecific(filepath).getFullpath()
+        self.end_live()
+        os_filepath = os.path.abspath(filepath)
+        filepath = Filename.fromOsSpecific(os_filepath).getFullpath()
 
         if self.source_mesh_node is not None:
             self.source_mesh_node.removeNode()
-        self.source_mesh_node = self.loader.loadModel(filepath).findAllMatches('**/+GeomNode')[0]
+        self.source_mesh_node = util.load_mesh_node(os_filepath)
         self.source_mesh_node.setColorScale(1, 0.5, 0.5, 1)
         self.source_mesh_node.setTransparency(TransparencyAttrib.MAlpha)
         self.source_mesh_node.setAlphaScale(0.5)
@@ -243,16 +288,20 @@ class App(ShowBase):
         if self.target_mesh_node is not None:
             self.target_mesh_node.show()
 
-        if self.source_pc_node is not None:
-            self.source_pc_node.removeNode()
-        self.source_pc_node = util.mesh_node_to_point_cloud_node(self.source_mesh_node)
-        self.source_pc_node.reparentTo(self.source_parent_node)
-        if self.target_pc_node is not None:
-            self.target_pc_node.show()
+        if self.source_pc_lod is not None:
+            self.source_pc_lod.removeNode()
+        # the compact cloud feeds processing and the LOD octree that displays it, then it is dropped: only the mesh
+        # node, the LOD chunks and the processed cloud stay in memory
+        cloud = CompactCloud.from_geom_node(self.source_mesh_node)
+        self.source_pc_lod = LodPointCloud.from_cloud(cloud, moving_points=lod_moving_points)
+        self.source_pc_lod.root.reparentTo(self.source_parent_node)
+        if self.target_pc_lod is not None:
+            self.target_pc_lod.root.show()
 
         if self.source_processed_pc_node is not None:
             self.source_processed_pc_node.removeNode()
-        self.source_processed_pc_node = util.process(self.source_pc_node, voxel_size)
+        self.source_processed_pc_node = util.process(cloud, voxel_size, os_filepath, source_filters)
+        del cloud
         self.source_processed_pc_node.reparentTo(self.source_parent_node)
         if self.target_processed_pc_node is not None:
             self.target_processed_pc_node.show()
@@ -267,29 +316,33 @@ class App(ShowBase):
 
 
     def load_target(self, filepath):
-        filepath = os.path.abspath(filepath)
-        filepath = Filename.fromOsSpecific(filepath).getFullpath()
+        self.end_live()
+        os_filepath = os.path.abspath(filepath)
+        filepath = Filename.fromOsSpecific(os_filepath).getFullpath()
 
         if self.target_mesh_node is not None:
             self.target_mesh_node.removeNode()
-        self.target_mesh_node = self.loader.loadModel(filepath).findAllMatches('**/+GeomNode')[0]
+        self.target_mesh_node = util.load_mesh_node(os_filepath)
         self.target_mesh_node.setColorScale(0.5, 1, 0.5, 1)
         self.target_mesh_node.reparentTo(self.target_parent_node)
         if self.source_mesh_node is not None:
             self.source_mesh_node.show()  # set to default hidden setting (synchronize between source and target)
 
-        if self.target_pc_node is not None:
-            self.target_pc_node.removeNode()
-        self.target_pc_node = util.mesh_node_to_point_cloud_node(self.target_mesh_node)
-        self.target_pc_node.reparentTo(self.target_parent_node)
-        if self.source_pc_node is not None:
-            self.source_pc_node.show()
-        self.cam_pivot.setPos(self.target_pc_node.getBounds().getCenter())
+        if self.target_pc_lod is not None:
+            self.target_pc_lod.removeNode()
+        cloud = CompactCloud.from_geom_node(self.target_mesh_node)
+        self.target_pc_lod = LodPointCloud.from_cloud(cloud, moving_points=lod_moving_points)
+        self.target_pc_lod.root.reparentTo(self.target_parent_node)
+        if self.source_pc_lod is not None:
+            self.source_pc_lod.root.show()
+        self.cam_pivot.setPos(self.target_pc_lod.root.getBounds().getCenter())
 
         if self.target_processed_pc_node is not None:
             self.target_processed_pc_node.removeNode()
-        self.target_processed_pc_node = util.process(self.target_pc_node, voxel_size)
+        self.target_processed_pc_node = util.process(cloud, voxel_size, os_filepath, target_filters)
+        del cloud
         self.target_processed_pc_node.reparentTo(self.target_parent_node)
+        self.target_index = TargetIndex(self.target_processed_pc_node, voxel_size)
         if self.source_processed_pc_node is not None:
             self.source_processed_pc_node.show()
 
@@ -300,7 +353,7 @@ class App(ShowBase):
         self.filtered_pc_view_var.set(1)
 
     def change_source(self):
-        file = tkinter.filedialog.askopenfilename(initialdir="/", title="Select file")
+        file = tkinter.filedialog.askopenfilename(initialdir="/", title="Select file", filetypes=file_types)
 
         if file == '':
             return
@@ -308,7 +361,7 @@ class App(ShowBase):
         self.load_source(file)
 
     def change_target(self):
-        file = tkinter.filedialog.askopenfilename(initialdir="/", title="Select file")
+        file = tkinter.filedialog.askopenfilename(initialdir="/", title="Select file", filetypes=file_types)
 
         if file == '':
             return
@@ -321,8 +374,8 @@ class App(ShowBase):
         self.switch_node(self.target_mesh_node)
 
     def switch_source_pc(self):
-        self.switch_node(self.source_pc_node)
-        self.switch_node(self.target_pc_node)
+        self.switch_node(self.source_pc_lod.root)
+        self.switch_node(self.target_pc_lod.root)
 
     def switch_source_processed_pc(self):
         self.switch_node(self.source_processed_pc_node)
@@ -354,14 +407,109 @@ class App(ShowBase):
     def init_transform(self):
         self.source_parent_node.setMat(LMatrix4f.identMat())
 
+    # registration runs on a worker thread, update_job applies the result when it is ready
     def global_registration(self):
-        result = util.global_registration(self.source_processed_pc_node, self.target_processed_pc_node, voxel_size)
-        self.source_parent_node.setMat(util.numpy_array_to_mat4(result))
+        self.end_live()
+        # cancel stops the RANSAC between its chunks
+        progress = Progress()
+        self.jobs.submit("global registration", functools.partial(util.global_registration, progress=progress),
+                         util.geom_node_to_pcd(self.source_processed_pc_node),
+                         util.geom_node_to_pcd(self.target_processed_pc_node), voxel_size, progress=progress)
 
     def local_registration(self):
-        result = util.local_registration(self.source_processed_pc_node, self.target_processed_pc_node,
-                                         util.numpy_array_to_mat4(self.source_parent_node.getMat()), voxel_size)
-        self.source_parent_node.setMat(util.numpy_array_to_mat4(result))
+        initial_transformation = np.array(util.numpy_array_to_mat4(self.source_parent_node.getMat()))
+        source_pcd = util.geom_node_to_pcd(self.source_processed_pc_node)
+        self.end_live()
+        callback = None
+        if self.live_icp_var.get():
+            self.live = Progress()
+            self.live_status = ""
+            scorer = None
+            if self.residual_colors_var.get():
+                scorer = PoseScorer(self.target_index, residual_color_distance)
+                self.source_colors = read_column(self.source_vertex_data(), 'color')
+            callback = functools.partial(self.publish_iteration, self.live, source_pcd, scorer)
+        self.jobs.submit("local registration", util.local_registration, source_pcd, self.target_index,
+                         initial_transformation, voxel_size, Method.OPEN3D_GREATEST, False, posestore.default_store,
+                         callback, progress=self.live)
+
+    @staticmethod
+    def publish_iteration(progress, source_pcd, scorer, iteration, transformation, result):
+        # runs on the registration thread, no Panda3D or Tk calls here: update_job applies the newest iteration
+        if progress.stopped:
+            return False
+        if progress.wanted():
+            colors = None
+            if scorer is not None:
+                colors = util.residual_colors(scorer.residuals(source_pcd, transformation), residual_color_distance)
+            progress.publish((iteration, np.array(transformation), result.fitness, colors))
+        return True
+
+    def show_iteration(self):
+        update = self.live.take()
+        if update is None:
+            return
+        iteration, transformation, fitness, colors = update
+        self.source_parent_node.setMat(util.numpy_array_to_mat4(transformation))
+        if colors is not None:
+            write_colors(self.source_vertex_data(), colors)  # in place, the GeomNode is kept
+        self.live_status = ", iteration %d, fitness %.4f" % (iteration, fitness)
+
+    def end_live(self):
+        if self.live is not None:
+            self.live.stopped = True
+            self.live = None
+        if self.source_colors is not None:
+            write_colors(self.source_vertex_data(), self.source_colors)
+            self.source_colors = None
+
+    def source_vertex_data(self):
+        return self.source_processed_pc_node.node().modifyGeom(0).modifyVertexData()
+
+    def warm_start(self):
+        # best local registration result stored for this pair, as a starting point for the next one
+        key = util.pose_store_key(util.geom_node_to_pcd(self.source_processed_pc_node), self.target_index, voxel_size)
+        best = posestore.default_store.best(key)
+        if best is None:
+            self.job_label["text"] = "no stored pose"
+            return
+        self.source_parent_node.setMat(util.array_to_mat4(best['resultPose']))
+        self.job_label["text"] = "stored pose: fitness %.4f" % best['fitness']
+
+    def cancel_registration(self):
+        if self.jobs.busy():
+            self.jobs.cancel()
+            self.end_live()
+            self.job_label["text"] = "cancelled"
+
+    def update_job(self, task):
+        job = self.jobs.poll()
+        if job is not None:
+            self.end_live()
+            if job.error is None:
+                self.source_parent_node.setMat(util.numpy_array_to_mat4(job.result))
+                self.job_label["text"] = "%s: %.2f sec" % (job.name, job.elapsed())
+            else:
+                self.job_label["text"] = "%s failed" % job.name
+        elif self.jobs.busy():
+            if self.live is not None:
+                self.show_iteration()
+            self.job_label["text"] = "%s... %.1f sec%s" % (self.jobs.current.name, self.jobs.current.elapsed(),
+                                                           self.live_status if self.live is not None else "")
+        return task.cont
+
+    def update_lod(self, task):
+        lods = [lod for lod in (self.source_pc_lod, self.target_pc_lod) if lod is not None]
+        now = globalClock.getFrameTime()
+        if self.view_changed:
+            self.view_changed = False
+            self.last_view_change = now
+            for lod in lods:
+                lod.coarsen()
+        elif now - self.last_view_change > lod_idle_delay:
+            for lod in lods:
+                lod.refine(self.camera, lod_refine_points)
+        return task.cont
 
     # Functions for camera zoom
     def zoom_out(self):
@@ -398,5 +546,6 @@ class App(ShowBase):
         return task.again
 
 
-app = App()
-app.run()
+if __name__ == '__main__':
+    app = App()
+    app.run()
@@ -0,0 +1,153 @@
+"""Native binary point cloud format (.npc).
+
+A 64 byte header followed by column blocks, each aligned to 64 bytes, so the file can be memory-mapped straight
+into numpy without parsing:
+
+    magic      8s   b'NPCLOUD\\0'
+    version    u4
+    flags      u4   1: normals, 2: colors
+    count      u8   number of points
+    offsets    3u8  byte offsets of points (float32 xyz), normals (float32 xyz) and colors (uint8 rgb), 0 if absent
+    reserved   16x
+
+usage: python pcformat.py convert input.obj|input.ply output.npc
+       python pcformat.py info file.npc
+"""
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+import open3d as o3d
+
+import conversion
+
+
+extension = '.npc'
+magic = b'NPCLOUD\0'
+version = 1
+header = struct.Struct('<8sIIQQQQ16x')
+alignment = 64
+
+HAS_NORMALS = 1
+HAS_COLORS = 2
+
+
+def _align(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def is_native(filepath):
+    return os.path.splitext(filepath)[1].lower() == extension
+
+
+def write(filepath, points, normals=None, colors=None):
+    """colors are either uint8 or floats in [0, 1]."""
+    points = np.ascontiguousarray(points, dtype='<f4').reshape((-1, 3))
+    count = len(points)
+    columns = [points]
+    flags = 0
+    if normals is not None:
+        columns.append(np.ascontiguousarray(normals, dtype='<f4').reshape((-1, 3)))
+        flags |= HAS_NORMALS
+    else:
+        columns.append(None)
+    if colors is not None:
+        colors = np.asarray(colors)
+        if colors.dtype != np.uint8:
+            colors = np.rint(np.clip(colors, 0, 1) * 255).astype(np.uint8)
+        columns.append(np.ascontiguousarray(colors[:, :3]))
+        flags |= HAS_COLORS
+    else:
+        columns.append(None)
+
+    offsets = []
+    offset = _align(header.size)
+    for column in columns:
+        if column is None:
+            offsets.append(0)
+            continue
+        if len(column) != count:
+            raise ValueError("column has %d rows, expected %d" % (len(column), count))
+        offsets.append(offset)
+        offset = _align(offset + column.nbytes)
+
+    with open(filepath, 'wb') as f:
+        f.write(header.pack(magic, version, flags, count, *offsets))
+        for column, column_offset in zip(columns, offsets):
+            if column is not None:
+                f.seek(column_offset)
+                f.write(column.tobytes())
+        f.truncate(offset)
+
+
+def read(filepath):
+    """Memory-map a .npc file, returns read-only (points, normals, colors) arrays (normals/colors may be None)."""
+    with open(filepath, 'rb') as f:
+        _magic, _version, flags, count, *offsets = header.unpack(f.read(header.size))
+    if _magic != magic:
+        raise ValueError("%s is not a native point cloud file" % filepath)
+    if _version > version:
+        raise ValueError("%s has unsupported version %d" % (filepath, _version))
+
+    def column(offset, dtype):
+        if offset == 0 or count == 0:
+            return None
+        return np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=(count, 3))
+
+    points = column(offsets[0], '<f4')
+    if points is None:
+        points = np.zeros((0, 3), dtype=np.float32)
+    normals = column(offsets[1], '<f4') if flags & HAS_NORMALS else None
+    colors = column(offsets[2], np.uint8) if flags & HAS_COLORS else None
+    return points, normals, colors
+
+
+def load_pcd(filepath):
+    points, normals, colors = read(filepath)
+    if colors is not None:
+        colors = colors / 255.0
+    return conversion.arrays_to_pcd(points, normals, colors)
+
+
+def load_geom_node(filepath):
+    points, normals, colors = read(filepath)
+    if colors is not None:
+        colors = colors / np.float32(255)
+    return conversion.arrays_to_geom_node(points, normals, colors)
+
+
+def read_source(filepath):
+    """Read the vertices of an OBJ (through the Panda3D loader, as the App sees them) or a PLY file."""
+    if os.path.splitext(filepath)[1].lower() == '.ply':
+        pcd = o3d.io.read_point_cloud(filepath)
+        return conversion.pcd_to_arrays(pcd)
+
+    import util  # util imports this module
+    return conversion.geom_node_to_arrays(util.load_mesh_node(filepath))
+
+
+def convert(source_path, target_path):
+    points, normals, colors = read_source(source_path)
+    write(target_path, points, normals, colors)
+    return len(points)
+
+
+def main(argv):
+    if len(argv) == 3 and argv[0] == 'convert':
+        start = time.time()
+        count = convert(argv[1], argv[2])
+        print(":: %d points written to %s (%.3f sec)." % (count, argv[2], time.time() - start))
+    elif len(argv) == 2 and argv[0] == 'info':
+        points, normals, colors = read(argv[1])
+        print(":: %s: %d points, normals: %s, colors: %s"
+              % (argv[1], len(points), normals is not None, colors is not None))
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+"""Pose memoization and warm starts for local registration.
+
+Results are grouped by pair: the content hashes of the processed source and target clouds plus the registration
+parameters (method, voxel size, pyramid). A run whose initial pose is within tolerance of a stored run of the same
+pair reuses its result, and the best stored result of a pair is offered as a warm start. Results are kept as the
+results of data/meta.json: resultPose is the 4x4 transformation row by row (what set_source_transform reads),
+initialPose the starting pose column by column.
+
+The store is one JSON file, rewritten after every new result. Least recently used pairs are dropped beyond max_pairs,
+and within a pair the oldest results (never the best one) beyond max_results.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import featurecache
+
+
+default_store_path = os.path.join(os.path.expanduser('~'), '.cache', 'PointCloudRegistration-Py', 'poses.json')
+version = 1
+
+
+def to_result_pose(pose):
+    return [float(v) for v in np.asarray(pose, dtype=np.float64).reshape(16)]
+
+
+def from_result_pose(values):
+    return np.array(values, dtype=np.float64).reshape((4, 4))
+
+
+def to_initial_pose(pose):
+    return to_result_pose(np.asarray(pose).T)
+
+
+def from_initial_pose(values):
+    return from_result_pose(values).T
+
+
+def pose_difference(a, b):
+    """Rotation angle (degrees) and translation distance between two poses."""
+    a, b = np.asarray(a), np.asarray(b)
+    cos = np.clip((np.trace(a[:3, :3].T @ b[:3, :3]) - 1) / 2, -1, 1)
+    return float(np.degrees(np.arccos(cos))), float(np.linalg.norm(a[:3, 3] - b[:3, 3]))
+
+
+def _better(a, b):
+    return (a['fitness'], -a['inlier_rmse']) > (b['fitness'], -b['inlier_rmse'])
+
+
+class PoseStore:
+    def __init__(self, path=default_store_path, max_pairs=256, max_results=16, rotation_tolerance=0.5,
+                 translation_tolerance=0.1):
+        """rotation_tolerance is in degrees, translation_tolerance in voxel sizes. path None keeps it in memory."""
+        self.path = path
+        self.max_pairs = max_pairs
+        self.max_results = max_results
+        self.rotation_tolerance = rotation_tolerance
+        self.translation_tolerance = translation_tolerance
+        self.pairs = None  # key -> {'results': [...], 'used': time}, loaded on first use
+        self.lock = threading.Lock()  # registrations run on worker threads
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source_pcd, target_pcd, method, voxel_size, pyramid=False):
+        return "%s_%s_%s_%g_%d" % (featurecache.cloud_hash(source_pcd), featurecache.cloud_hash(target_pcd), method,
+                                   voxel_size, pyramid)
+
+    def _load(self):
+        if self.pairs is not None:
+            return
+        self.pairs = OrderedDict()
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # a damaged store is started over
+        if data.get('version') == version:
+            for key, pair in sorted(data['pairs'].items(), key=lambda item: item[1]['used']):
+                self.pairs[key] = pair
+
+    def lookup(self, key, initial, voxel_size):
+        """The stored result (a dict with resultPose, fitness, inlier_rmse) of a run started near initial, or None."""
+        with self.lock:
+            self._load()
+            pair = self.pairs.get(key)
+            match = None
+            for result in [] if pair is None else pair['results']:
+                rotation, translation = pose_difference(from_initial_pose(result['initialPose']), initial)
+                if rotation <= self.rotation_tolerance and translation <= self.translation_tolerance * voxel_size:
+                    if match is None or _better(result, match):
+                        match = result
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            pair['used'] = time.time()
+            self.pairs.move_to_end(key)
+            return match
+
+    def best(self, key):
+        """The best stored result of a pair (highest fitness, then lowest inlier RMSE), or None."""
+        with self.lock:
+            self._load()
+            pair = self.pairs.get(key)
+            if pair is None or len(pair['results']) == 0:
+                return None
+            best = pair['results'][0]
+            for result in pair['results'][1:]:
+                if _better(result, best):
+                    best = result
+            return best
+
+    def add(self, key, initial, pose, fitness, inlier_rmse):
+        result = {'initialPose': to_initial_pose(initial), 'resultPose': to_result_pose(pose),
+                  'fitness': float(fitness), 'inlier_rmse': float(inlier_rmse), 'time': time.time()}
+        with self.lock:
+            self._load()
+            pair = self.pairs.setdefault(key, {'results': []})
+            pair['used'] = result['time']
+            pair['results'].append(result)
+            self.pairs.move_to_end(key)
+            self._evict(pair)
+            self._save()
+        return result
+
+    def _evict(self, pair):
+        results = pair['results']
+        while len(results) > self.max_results:
+            best = max(range(len(results)), key=lambda i: (results[i]['fitness'], -results[i]['inlier_rmse']))
+            del results[1 if best == 0 else 0]  # results are in insertion order, drop the oldest but the best
+        while len(self.pairs) > self.max_pairs:
+            self.pairs.popitem(last=False)
+
+    def _save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # write then rename, so a crash never leaves a partial store
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': version, 'pairs': self.pairs}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self.lock:
+            self.pairs = OrderedDict()
+            self._save()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            self._load()
+            return {'hits': self.hits, 'misses': self.misses, 'pairs': len(self.pairs),
+                    'results': sum(len(pair['results']) for pair in self.pairs.values())}
+
+
+default_store = PoseStore()
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import conversion
+
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'PointCloudRegistration-Py', 'processed')
+
+
+class ProcessCache:
+    """Processed (filtered + down sampled + normals) clouds on disk, keyed by source file and processing parameters.
+
+    Entries are uncompressed .npz files holding float32 points/normals and uint8 colors. When the directory grows
+    beyond max_bytes the least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=512 * 2 ** 20, hash_content=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content  # hash the file bytes instead of trusting mtime and size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filepath, voxel_size, normal_radius, normal_max_nn, filters=None):
+        filepath = os.path.abspath(filepath)
+        h = hashlib.sha1(filepath.encode('utf-8'))
+        if self.hash_content:
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    h.update(block)
+        else:
+            stat = os.stat(filepath)
+            h.update(("%d_%d" % (stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+        h.update(("%g_%g_%d" % (voxel_size, normal_radius, normal_max_nn)).encode('utf-8'))
+        if filters is not None:
+            h.update(repr(filters).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                points = npz['points']
+                normals = npz['normals'] if 'normals' in npz else None
+                colors = npz['colors'].astype(np.float32) / 255.0 if 'colors' in npz else None
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        os.utime(path)  # mark as recently used
+        self.hits += 1
+        return conversion.arrays_to_pcd(points, normals, colors)
+
+    def put(self, key, pcd):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        points, normals, colors = conversion.pcd_to_arrays(pcd)
+        arrays = {'points': points.astype(np.float32)}
+        if normals is not None:
+            arrays['normals'] = normals.astype(np.float32)
+        if colors is not None:
+            arrays['colors'] = np.rint(np.clip(colors, 0, 1) * 255).astype(np.uint8)
+
+        # write then rename, so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self._path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz') or name == "%s.npz" % keep:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(self._path(keep)):
+            total += os.path.getsize(self._path(keep))
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+
+default_cache = ProcessCache()
@@ -0,0 +1,106 @@
+"""Client of the warm local registration service (registrationservice.py).
+
+Only numpy and the standard library are imported, so a client process does not pay for open3d, cv2 or panda3d.
+
+Protocol: one JSON object per line in each direction over a Unix socket. Every reply has "ok", failed requests
+carry "error" instead of results.
+
+    {"op": "ping"}
+    {"op": "load_target", "target": path, "voxel_size": v, "filter": "none"}
+    {"op": "register", "target": path, "voxel_size": v, "source": {...}, "initial": 4x4 or null,
+     "method": "OPEN3D_GREATEST", "pyramid": false, "processed": false, "filter": "none"}
+    {"op": "shutdown"}
+
+The register source is {"shm": name, "count": n, "columns": 3 or 6}, n float32 rows of xyz (+ normals) in a
+multiprocessing.shared_memory segment, or {"path": file} for a model file the service loads itself (.npc files are
+memory-mapped). Without an initial pose the service runs global registration first. processed sources are used as
+they are, others are down sampled (and get normals) first.
+"""
+import json
+import os
+import socket
+import tempfile
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+default_socket = os.path.join(tempfile.gettempdir(), 'pcregistration.sock')
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+class RegistrationClient:
+    def __init__(self, socket_path=default_socket, timeout=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(socket_path)
+        self.reader = self.socket.makefile('r')
+        self.shm = None  # reused by every register call, grown when a source does not fit
+
+    def request(self, **message):
+        self.socket.sendall((json.dumps(message) + "\n").encode())
+        line = self.reader.readline()
+        if line == '':
+            raise ServiceError("service closed the connection")
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise ServiceError(reply.get('error', "unknown error"))
+        return reply
+
+    def ping(self):
+        return self.request(op='ping')
+
+    def load_target(self, target, voxel_size, filter='none'):
+        """Prepare a target ahead of the first registration against it."""
+        return self.request(op='load_target', target=os.path.abspath(target), voxel_size=voxel_size, filter=filter)
+
+    def _shared(self, points, normals):
+        rows = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+        if normals is not None:
+            rows = np.hstack((rows, np.asarray(normals, dtype=np.float32).reshape((-1, 3))))
+        if self.shm is None or self.shm.size < rows.nbytes:
+            self._release()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(rows.nbytes, 2 ** 20))
+        np.ndarray(rows.shape, dtype=np.float32, buffer=self.shm.buf)[:] = rows
+        return {'shm': self.shm.name, 'count': len(rows), 'columns': rows.shape[1]}
+
+    def register(self, target, points, normals=None, initial=None, voxel_size=0.005, method='OPEN3D_GREATEST',
+                 pyramid=False, processed=False, filter='none'):
+        """Register source points (and normals) to a target file, returns the 4x4 pose and the whole reply."""
+        return self._register(target, self._shared(points, normals), initial, voxel_size, method, pyramid, processed,
+                              filter)
+
+    def register_file(self, target, source, initial=None, voxel_size=0.005, method='OPEN3D_GREATEST', pyramid=False,
+                      filter='none'):
+        return self._register(target, {'path': os.path.abspath(source)}, initial, voxel_size, method, pyramid, False,
+                              filter)
+
+    def _register(self, target, source, initial, voxel_size, method, pyramid, processed, filter):
+        reply = self.request(op='register', target=os.path.abspath(target), voxel_size=voxel_size, source=source,
+                             initial=None if initial is None else np.asarray(initial).tolist(), method=method,
+                             pyramid=pyramid, processed=processed, filter=filter)
+        return np.array(reply['pose']), reply
+
+    def shutdown(self):
+        return self.request(op='shutdown')
+
+    def _release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        self._release()
+        self.reader.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,204 @@
+"""Warm local registration service.
+
+A one-shot registration pays for importing open3d, cv2 and panda3d and for loading and processing its target before
+any work is done. The service pays that once: it keeps the processed targets (cloud + TargetIndex, per target file,
+voxel size and filter) and the FPFH features in memory and answers registration requests over a Unix socket, each
+connection on its own thread. Sources arrive through shared memory (or as a file path), see registrationclient for
+the protocol and the client.
+
+usage: python registrationservice.py [--socket /tmp/pcregistration.sock] [--target scene.obj ...]
+                                     [--voxel-size 0.005] [--target-filter none] [--max-targets 8]
+                                     [--stages stages.jsonl] [--quiet]
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import open3d as o3d
+
+import featurecache
+import filtering
+import instrumentation
+import util
+from compactcloud import CompactCloud
+from conversion import arrays_to_pcd
+from instrumentation import log
+from localregistration import Method, TargetIndex
+from registrationclient import default_socket
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        # the client owns the segment, the tracker would otherwise unlink it when the service exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class RegistrationService:
+    def __init__(self, max_targets=8):
+        self.targets = featurecache.LRUCache(max_entries=max_targets)
+        self.lock = threading.Lock()  # one target load at a time, requests for the same target wait for it
+        self.requests = 0
+
+    def target(self, path, voxel_size, filter_name='none'):
+        """The processed target cloud and its TargetIndex, loaded on first use."""
+        # a target rewritten in place gets a new key, the stale entry ages out of the LRU
+        stat = os.stat(path)
+        key = "%s_%d_%d_%g_%s" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, voxel_size, filter_name)
+        entry = self.targets.get(key)
+        if entry is None:
+            with self.lock:
+                entry = self.targets.get(key)
+                if entry is None:
+                    pcd = util.process_pcd(util.load_cloud(path), voxel_size, path,
+                                           filters=filtering.presets[filter_name])
+                    entry = (pcd, TargetIndex(pcd, voxel_size))
+                    self.targets.put(key, entry)
+                    log(":: Target %s ready (%d points)." % (path, len(pcd.points)))
+        return entry
+
+    def source(self, spec, voxel_size, processed, attached):
+        if 'path' in spec:
+            return util.process_pcd(util.load_cloud(spec['path']), voxel_size)
+
+        shm = attached.get(spec['shm'])
+        if shm is None:
+            for previous in attached.values():
+                previous.close()
+            attached.clear()
+            shm = attached[spec['shm']] = _attach(spec['shm'])
+        rows = np.ndarray((spec['count'], spec['columns']), dtype=np.float32, buffer=shm.buf)
+        normals = rows[:, 3:6] if spec['columns'] >= 6 else None
+        if processed:
+            pcd = arrays_to_pcd(rows[:, :3], normals)
+            if normals is None:
+                pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(
+                    radius=voxel_size * util.normal_radius_factor, max_nn=util.normal_max_nn))
+            return pcd
+        return util.process_pcd(CompactCloud(rows[:, :3], normals), voxel_size)
+
+    def register(self, message, attached):
+        voxel_size = message['voxel_size']
+        timings = {}
+
+        start = time.perf_counter()
+        target_pcd, target_index = self.target(message['target'], voxel_size, message.get('filter', 'none'))
+        timings['target'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        source_pcd = self.source(message['source'], voxel_size, message.get('processed', False), attached)
+        timings['source'] = time.perf_counter() - start
+
+        initial = message.get('initial')
+        if initial is None:
+            start = time.perf_counter()
+            initial = util.global_registration(source_pcd, target_pcd, voxel_size)
+            timings['global'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pose = util.local_registration(source_pcd, target_index, np.asarray(initial, dtype=np.float64), voxel_size,
+                                       Method[message.get('method', Method.OPEN3D_GREATEST.name)],
+                                       message.get('pyramid', False))
+        timings['local'] = time.perf_counter() - start
+
+        evaluation = o3d.pipelines.registration.evaluate_registration(source_pcd, target_pcd, voxel_size * 0.4,
+                                                                      np.asarray(pose))
+        return {'pose': np.asarray(pose).tolist(), 'fitness': evaluation.fitness,
+                'inlier_rmse': evaluation.inlier_rmse, 'source_points': len(source_pcd.points), 'timings': timings}
+
+    def handle(self, message, attached):
+        """Reply to one request, attached holds the shared memory segments of the connection."""
+        op = message.get('op')
+        # handlers run on one thread per connection, the target cache lock also guards the request counter
+        with self.targets.lock:
+            self.requests += 1
+            requests, targets = self.requests, list(self.targets.entries)
+        try:
+            if op == 'ping':
+                reply = {'requests': requests, 'targets': targets}
+            elif op == 'load_target':
+                start = time.perf_counter()
+                pcd, _ = self.target(message['target'], message['voxel_size'], message.get('filter', 'none'))
+                reply = {'points': len(pcd.points), 'seconds': time.perf_counter() - start}
+            elif op == 'register':
+                reply = self.register(message, attached)
+            else:
+                return {'ok': False, 'error': "unknown op %r" % op}
+        except Exception as e:
+            traceback.print_exc()
+            return {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+        reply['ok'] = True
+        return reply
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        attached = {}
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message.get('op') == 'shutdown':
+                    self.wfile.write(b'{"ok": true}\n')
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+                reply = self.server.service.handle(message, attached)
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+        finally:
+            for shm in attached.values():
+                shm.close()
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # left behind by a service that did not exit cleanly
+        super().__init__(socket_path, _Handler)
+        self.service = service
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm local registration service.")
+    parser.add_argument('--socket', default=default_socket)
+    parser.add_argument('--target', action='append', default=[], help="target to prepare at start, repeatable")
+    parser.add_argument('--voxel-size', type=float, default=0.005, help="voxel size of the --target clouds")
+    parser.add_argument('--target-filter', choices=filtering.presets, default='none')
+    parser.add_argument('--max-targets', type=int, default=8, help="processed targets kept in memory")
+    parser.add_argument('--stages', help="append per-stage instrumentation records (JSON lines) to this file")
+    parser.add_argument('--quiet', action='store_true', help="no pipeline progress messages")
+    args = parser.parse_args(argv)
+
+    sys.stdout = sys.stderr
+    instrumentation.set_quiet(args.quiet)
+    if args.stages is not None:
+        instrumentation.add_sink(instrumentation.JsonLinesSink(args.stages))
+
+    service = RegistrationService(args.max_targets)
+    for target in args.target:
+        service.target(os.path.abspath(target), args.voxel_size, args.target_filter)
+
+    server = Server(args.socket, service)
+    print(":: Registration service listening on %s." % args.socket, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""Out-of-core loading: model files read in fixed-size chunks and down sampled as they stream in.
+
+read_chunks yields (points, normals, colors) chunks of at most chunk_points rows from binary/ASCII PLY, OBJ and .npc
+files, never the whole scan. VoxelAccumulator keeps per-voxel sums (centroid, normal, color and count) across chunks,
+so memory is bounded by the chunk size plus the down sampled output.
+
+The voxel grid is anchored at the origin instead of at the cloud's minimum bound (which a stream does not know in
+advance), so the voxels differ slightly from PointCloud.voxel_down_sample and the point count can differ by a few
+percent.
+"""
+import itertools
+import os
+
+import numpy as np
+
+import pcformat
+from compactcloud import CompactCloud
+from instrumentation import log, stage
+
+
+default_chunk_points = 2 ** 20
+
+_ply_types = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+_ply_orders = {'binary_little_endian': '<', 'binary_big_endian': '>', 'ascii': None}
+
+
+def _read_ply_header(f):
+    if f.readline().strip() != b'ply':
+        raise ValueError("not a PLY file")
+    fmt = None
+    elements = []  # (name, count, [(property, type)]), list properties have type None
+    while True:
+        line = f.readline()
+        if line == b'':
+            raise ValueError("PLY header has no end_header")
+        words = line.decode('ascii', 'replace').split()
+        if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], None))
+            else:
+                elements[-1][2].append((words[2], _ply_types[words[1]]))
+    if fmt not in _ply_orders:
+        raise ValueError("unsupported PLY format %s" % fmt)
+    return fmt, elements
+
+
+def _columns(names, rows):
+    """(points, normals, colors) from a structured chunk, colors as uint8."""
+    def stack(columns, dtype):
+        if not all(c in names for c in columns):
+            return None
+        return np.stack([rows[c] for c in columns], axis=1).astype(dtype)
+
+    points = stack(('x', 'y', 'z'), np.float32)
+    normals = stack(('nx', 'ny', 'nz'), np.float32)
+    colors = None
+    for columns in (('red', 'green', 'blue'), ('r', 'g', 'b')):
+        if all(c in names for c in columns):
+            colors = np.stack([rows[c] for c in columns], axis=1)
+            if colors.dtype.kind == 'f':
+                colors = np.rint(np.clip(colors, 0, 1) * 255)
+            colors = colors.astype(np.uint8)
+            break
+    return points, normals, colors
+
+
+def read_ply_chunks(filepath, chunk_points=default_chunk_points):
+    with open(filepath, 'rb') as f:
+        fmt, elements = _read_ply_header(f)
+        order = _ply_orders[fmt]
+        for name, count, properties in elements:
+            names = [p for p, _ in properties]
+            if name == 'vertex':
+                break
+            # elements stored ahead of the vertices are skipped, which needs their size
+            if order is None:
+                for _ in range(count):
+                    f.readline()
+            elif any(t is None for _, t in properties):
+                raise ValueError("%s: can not skip the list element '%s' ahead of the vertices" % (filepath, name))
+            else:
+                f.seek(count * np.dtype([(p, order + t) for p, t in properties]).itemsize, os.SEEK_CUR)
+        else:
+            raise ValueError("%s has no vertex element" % filepath)
+        if any(t is None for _, t in properties):
+            raise ValueError("%s: list properties in the vertex element are not supported" % filepath)
+
+        if order is None:
+            dtype = np.dtype([(p, t) for p, t in properties])
+            for start in range(0, count, chunk_points):
+                lines = list(itertools.islice(f, min(chunk_points, count - start)))
+                values = np.array(b' '.join(lines).split(), dtype=np.float64).reshape((len(lines), len(properties)))
+                rows = np.empty(len(lines), dtype=dtype)
+                for i, p in enumerate(names):
+                    rows[p] = values[:, i]
+                yield _columns(names, rows)
+        else:
+            dtype = np.dtype([(p, order + t) for p, t in properties])
+            for start in range(0, count, chunk_points):
+                rows = min(chunk_points, count - start)
+                data = f.read(rows * dtype.itemsize)
+                if len(data) < rows * dtype.itemsize:
+                    raise ValueError("%s is truncated" % filepath)
+                yield _columns(names, np.frombuffer(data, dtype=dtype))
+
+
+def _obj_rows(filepath, prefix, chunk_points):
+    # the rest of the lines starting with prefix, chunk_points lines at a time
+    with open(filepath, 'rb') as f:
+        lines = (line[len(prefix):] for line in f if line.startswith(prefix))
+        while True:
+            chunk = list(itertools.islice(lines, chunk_points))
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def _parse_rows(lines, width):
+    values = b' '.join(lines).split()
+    if len(values) == width * len(lines):
+        return np.array(values, dtype=np.float32).reshape((len(lines), width))
+    rows = [line.split()[:width] for line in lines]
+    if any(len(row) != width for row in rows):
+        width = 3  # some vertices without colors, colors are dropped for the chunk
+        rows = [row[:3] for row in rows]
+    return np.array(rows, dtype=np.float32)
+
+
+def read_obj_chunks(filepath, chunk_points=default_chunk_points):
+    """OBJ vertices ('v x y z [r g b]'), without normals.
+
+    OBJ faces pair vertices and 'vn' normals through their own indices ('f v//vn'), resolving them needs every normal
+    at hand, which a stream does not have. The processed cloud gets its normals estimated after down sampling anyway.
+    """
+    for lines in _obj_rows(filepath, b'v ', chunk_points):
+        values = _parse_rows(lines, 6 if len(lines[0].split()) >= 6 else 3)
+        colors = None
+        if values.shape[1] == 6:
+            colors = np.rint(np.clip(values[:, 3:6], 0, 1) * 255).astype(np.uint8)
+        yield np.ascontiguousarray(values[:, :3]), None, colors
+
+
+def read_npc_chunks(filepath, chunk_points=default_chunk_points):
+    points, normals, colors = pcformat.read(filepath)
+    for start in range(0, len(points), chunk_points):
+        end = start + chunk_points
+        yield (np.array(points[start:end]), None if normals is None else np.array(normals[start:end]),
+               None if colors is None else np.array(colors[start:end]))
+
+
+def read_chunks(filepath, chunk_points=default_chunk_points):
+    """Yield (points, normals, colors) chunks of a .ply, .obj or .npc file, normals/colors may be None."""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension == '.ply':
+        return read_ply_chunks(filepath, chunk_points)
+    if extension == '.obj':
+        return read_obj_chunks(filepath, chunk_points)
+    if pcformat.is_native(filepath):
+        return read_npc_chunks(filepath, chunk_points)
+    raise ValueError("%s: streaming supports .ply, .obj and .npc files" % filepath)
+
+
+class VoxelAccumulator:
+    """Incremental voxel grid down sampling: per-voxel sums of points, normals and colors, merged chunk by chunk."""
+
+    bits = 21  # per axis, voxel indices within +-2^20 of the origin
+
+    def __init__(self, voxel_size):
+        self.voxel_size = voxel_size
+        self.keys = np.zeros(0, dtype=np.int64)  # sorted
+        self.sums = None  # (voxels, 10): point xyz, normal xyz, color rgb, count
+        self.points_in = 0
+        self.has_normals = None
+        self.has_colors = None
+
+    def _keys(self, points):
+        cells = np.floor(points / self.voxel_size).astype(np.int64)
+        limit = 1 << (self.bits - 1)
+        if cells.size and (cells.min() < -limit or cells.max() >= limit):
+            raise ValueError("cloud spans more than 2^%d voxels of %g, use a larger voxel size"
+                             % (self.bits, self.voxel_size))
+        cells += limit
+        return (cells[:, 0] << (2 * self.bits)) | (cells[:, 1] << self.bits) | cells[:, 2]
+
+    def add(self, points, normals=None, colors=None):
+        if len(points) == 0:
+            return
+        # a column missing from any chunk is dropped from the result
+        self.has_normals = normals is not None and self.has_normals is not False
+        self.has_colors = colors is not None and self.has_colors is not False
+        self.points_in += len(points)
+
+        chunk_keys, inverse = np.unique(self._keys(points), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        chunk_sums = np.zeros((len(chunk_keys), 10))
+        for i, column in enumerate((points, normals, colors)):
+            if column is None:
+                continue
+            for axis in range(3):
+                chunk_sums[:, 3 * i + axis] = np.bincount(inverse, weights=column[:, axis], minlength=len(chunk_keys))
+        chunk_sums[:, 9] = np.bincount(inverse, minlength=len(chunk_keys))
+
+        if self.sums is None:
+            self.keys, self.sums = chunk_keys, chunk_sums
+            return
+        keys, inverse = np.unique(np.concatenate((self.keys, chunk_keys)), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        merged = np.zeros((len(keys), 10))
+        # both key sets are unique, so each fancy-indexed add touches a voxel at most once
+        merged[inverse[:len(self.keys)]] += self.sums
+        merged[inverse[len(self.keys):]] += chunk_sums
+        self.keys, self.sums = keys, merged
+
+    def __len__(self):
+        return len(self.keys)
+
+    def result(self, name='PointCloud'):
+        """The down sampled CompactCloud (centroids, normalized mean normals, mean colors)."""
+        if self.sums is None:
+            return CompactCloud(np.zeros((0, 3), dtype=np.float32), name=name)
+        counts = self.sums[:, 9:10]
+        points = self.sums[:, 0:3] / counts
+        normals = None
+        if self.has_normals:
+            normals = self.sums[:, 3:6]
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            normals = normals / np.where(lengths > 0, lengths, 1)
+        colors = np.rint(self.sums[:, 6:9] / counts).astype(np.uint8) if self.has_colors else None
+        return CompactCloud(points, normals, colors, name)
+
+
+def stream_down_sample(filepath, voxel_size, chunk_points=default_chunk_points):
+    """Down sampled CompactCloud of a model file, read chunk by chunk."""
+    name = os.path.basename(filepath)
+    log(":: Streaming %s with a voxel size %.3f." % (name, voxel_size))
+    with stage('stream_downsample', file=name, voxel_size=voxel_size) as record:
+        accumulator = VoxelAccumulator(voxel_size)
+        chunks = 0
+        for points, normals, colors in read_chunks(filepath, chunk_points):
+            accumulator.add(points, normals, colors)
+            chunks += 1
+        cloud = accumulator.result(name)
+        record.update(points_in=accumulator.points_in, points_out=len(cloud), chunks=chunks)
+    return cloud
+
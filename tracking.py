@@ -0,0 +1,167 @@
+"""Frame-to-frame tracking of a model over a stream of scene frames.
+
+Every frame is registered from the previous frame's pose with local registration only. Global registration is run
+for the first frame and whenever the fitness falls below a threshold.
+
+usage: python tracking.py model.obj frames_dir [-o track.jsonl] [--voxel-size 0.005] [--min-fitness 0.3]
+                          [--method OPEN3D_GREATEST] [--pyramid] [--fast]
+                          [--frame-filter none] [--stages stages.jsonl] [--profile STAGE] [--quiet]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import open3d as o3d
+
+import filtering
+import instrumentation
+import util
+from localregistration import Method
+
+
+frame_extensions = ('.obj', '.ply', '.npc')
+
+
+def frames_from_directory(directory):
+    """Yield (name, CompactCloud) for every frame file of a directory, in file name order."""
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in frame_extensions:
+            yield name, util.load_cloud(os.path.join(directory, name))
+
+
+class Tracker:
+    def __init__(self, model, voxel_size, method=Method.OPEN3D_GREATEST, min_fitness=0.3, fast=False, pyramid=False,
+                 model_filters=None, frame_filters=None):
+        """model is a model file path or a raw (Open3D or compact) point cloud, processed once for the whole stream.
+
+        model_filters/frame_filters are filtering.FilterSettings applied before down sampling (None: no filtering).
+        """
+        self.voxel_size = voxel_size
+        self.method = method
+        self.min_fitness = min_fitness
+        self.fast = fast
+        self.pyramid = pyramid
+        self.frame_filters = frame_filters
+        self.fitness_distance = voxel_size
+
+        if isinstance(model, str):
+            self.model = util.process_pcd(util.load_cloud(model), voxel_size, model, filters=model_filters)
+        else:
+            self.model = util.process_pcd(model, voxel_size, filters=model_filters)
+
+        self.pose = None
+        self.fitness = 0.0
+        self.frame_count = 0
+
+    def reset(self):
+        self.pose = None
+        self.fitness = 0.0
+
+    def evaluate(self, frame, pose):
+        return o3d.pipelines.registration.evaluate_registration(self.model, frame, self.fitness_distance, pose)
+
+    def track(self, frame_pcd, name=None):
+        """Register the model against one raw frame, returns the per-frame report."""
+        timings = {}
+        start = time.perf_counter()
+
+        stage = time.perf_counter()
+        frame = util.process_pcd(frame_pcd, self.voxel_size, filters=self.frame_filters)
+        timings['process'] = time.perf_counter() - stage
+
+        relocalized = False
+        if self.pose is None or self.fitness < self.min_fitness:
+            stage = time.perf_counter()
+            self.pose = np.asarray(util.global_registration(self.model, frame, self.voxel_size, self.fast))
+            timings['global'] = time.perf_counter() - stage
+            relocalized = True
+
+        stage = time.perf_counter()
+        pose = np.asarray(util.local_registration(self.model, frame, self.pose, self.voxel_size,
+                                                  self.method, self.pyramid))
+        timings['local'] = time.perf_counter() - stage
+
+        evaluation = self.evaluate(frame, pose)
+        if evaluation.fitness < self.min_fitness and not relocalized:
+            # lost track, the next frame starts from a global registration
+            self.pose = None
+        else:
+            self.pose = pose
+        self.fitness = evaluation.fitness
+        timings['latency'] = time.perf_counter() - start
+
+        self.frame_count += 1
+        return {
+            'frame': name if name is not None else self.frame_count - 1,
+            'points': len(frame.points),
+            'pose': pose.tolist(),
+            'fitness': evaluation.fitness,
+            'inlier_rmse': evaluation.inlier_rmse,
+            'global_registration': relocalized,
+            'lost': self.pose is None,
+            'timings': timings,
+        }
+
+    def run(self, frames):
+        """Track a stream of frames, either point clouds or (name, point cloud) pairs."""
+        for frame in frames:
+            if isinstance(frame, tuple):
+                yield self.track(frame[1], frame[0])
+            else:
+                yield self.track(frame)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Track a model over a directory of scene frames.")
+    parser.add_argument('model')
+    parser.add_argument('frames', help="directory of frame files (%s)" % ", ".join(frame_extensions))
+    parser.add_argument('-o', '--output', help="JSON lines output file (default: stdout)")
+    parser.add_argument('--voxel-size', type=float, default=0.005)
+    parser.add_argument('--min-fitness', type=float, default=0.3,
+                        help="run global registration again when the fitness drops below this")
+    parser.add_argument('--method', choices=[m.name for m in Method], default=Method.OPEN3D_GREATEST.name)
+    parser.add_argument('--pyramid', action='store_true', help="coarse-to-fine local registration")
+    parser.add_argument('--fast', action='store_true', help="use FGR instead of RANSAC for global registration")
+    parser.add_argument('--frame-filter', choices=filtering.presets, default='none',
+                        help="noise filtering of every frame before down sampling ('background' also drops the plane)")
+    parser.add_argument('--stages', help="append per-stage instrumentation records (JSON lines) to this file")
+    parser.add_argument('--profile', metavar='STAGE', help="cProfile one stage (e.g. icp), written to STAGE.prof")
+    parser.add_argument('--quiet', action='store_true', help="no pipeline progress messages")
+    args = parser.parse_args(argv)
+
+    instrumentation.set_quiet(args.quiet)
+    histograms = instrumentation.add_sink(instrumentation.HistogramSink())
+    if args.stages:
+        instrumentation.add_sink(instrumentation.JsonLinesSink(args.stages))
+    if args.profile:
+        instrumentation.profile_stage(args.profile, args.profile + '.prof')
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    latencies = []
+    # keep the pipeline's progress prints off stdout, which carries the JSON lines
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        tracker = Tracker(args.model, args.voxel_size, Method[args.method], args.min_fitness, args.fast,
+                          args.pyramid, frame_filters=filtering.presets[args.frame_filter])
+        for result in tracker.run(frames_from_directory(args.frames)):
+            latencies.append(result['timings']['latency'])
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        sys.stdout = stdout
+        if output is not sys.stdout:
+            output.close()
+
+    if latencies:
+        print(":: %d frames, latency mean %.1f ms, max %.1f ms (%.1f fps)."
+              % (len(latencies), np.mean(latencies) * 1000, np.max(latencies) * 1000, 1 / np.mean(latencies)),
+              file=sys.stderr)
+        histograms.print_summary(file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,20 @@
+import os.path
 import open3d as o3d
 import numpy as np
 import time
 from panda3d.core import *
 
 import localregistration
-from localregistration import Method
+from localregistration import Method, TargetIndex
 import globalregistration
+import processcache
+import pcformat
+import filtering
+import posestore
+import streaming
+from compactcloud import CompactCloud
+from instrumentation import log, stage
+from conversion import geom_node_to_pcd, pcd_to_geom_node, mesh_node_to_point_cloud_node, geom_node_to_numpy_pc, as_pcd
 
 
 def array_to_mat4(a):
@@ -35,152 +44,146 @@ def mat4_to_numpy_array(a):
     )
 
 
-def process(source_node, voxel_size):
-    pcd = geom_node_to_pcd(source_node)
-    down_sampled_pcd = down_sampling(pcd, voxel_size)
-    return pcd_to_geom_node(down_sampled_pcd)
+normal_radius_factor = 2  # normal search radius, in voxel sizes
+normal_max_nn = 30
 
 
-def global_registration(source_node, target_node, voxel_size):
-    # parameters...
-    fast = False
-    ######################
+def process(source_node, voxel_size, filepath=None, filters=None):
+    return pcd_to_geom_node(process_pcd(source_node, voxel_size, filepath, filters=filters))
 
-    start = time.time()
-    source_pcd = geom_node_to_pcd(source_node)
-    target_pcd = geom_node_to_pcd(target_node)
-    pose = globalregistration.ransac_based_on_fpfh(source_pcd, target_pcd, voxel_size, fast)
-    print("Cost Time: %.3f sec" % (time.time() - start))
-    return pose
 
+def process_pcd(source, voxel_size, filepath=None, cache=None, filters=None):
+    # filters: filtering.FilterSettings applied before down sampling, None for no filtering
+    # with the file the cloud was loaded from, the result is cached on disk (see processcache)
+    if filepath is None:
+        return _process(source, voxel_size, filters)
 
-def local_registration(source_node, target_node, initial_transformation, voxel_size):
-    # parameters...
-    method = Method.OPEN3D_GREATEST
-    ######################
+    if cache is None:
+        cache = processcache.default_cache
+    key = cache.key(filepath, voxel_size, voxel_size * normal_radius_factor, normal_max_nn, filters)
+    processed = cache.get(key)
+    if processed is None:
+        processed = _process(source, voxel_size, filters)
+        cache.put(key, processed)
+    else:
+        log(":: Processed point cloud loaded from cache (%d points)." % len(processed.points))
+    return processed
 
+
+def global_registration(source_node, target_node, voxel_size, fast=False, multi_hypothesis=False, budget=None,
+                        ppf=False, progress=None):
+    # with a jobs.Progress, RANSAC runs as anytime RANSAC (without deadline unless a budget is given) and stops
+    # between its chunks once progress.stopped is set; PPF, FGR and multi-hypothesis runs can not be cancelled
     start = time.time()
-    if method == Method.OPENCV: # TODO: 지금 작동 안됨...
-        pose = localregistration.opencv_icp(source_node, target_node, initial_transformation)
-    elif method == Method.OPEN3D_DEFAULT:
-        pose = localregistration.open3d_icp(source_node, target_node, initial_transformation, voxel_size)
-    elif method == Method.OPEN3D_GREATEST:
-        pose = localregistration.open3d_gicp(source_node, target_node, initial_transformation, voxel_size)
-    elif method == Method.OPEN3D_COLORED:
-        pose = localregistration.colored_icp(source_node, target_node, initial_transformation, voxel_size)
-    print("Cost Time: %.3f sec" % (time.time() - start))
+    source_pcd = as_pcd(source_node)
+    target_pcd = as_pcd(target_node)
+    with stage('global_registration', points_in=len(source_pcd.points)):
+        if ppf:
+            pose = globalregistration.ppf(source_pcd, target_pcd, voxel_size)
+        elif budget is not None or (progress is not None and not fast and not multi_hypothesis):
+            pose = globalregistration.anytime_ransac(source_pcd, target_pcd, voxel_size, budget,
+                                                     progress=progress).transformation
+        elif multi_hypothesis:
+            pose, _ = globalregistration.multi_hypothesis(source_pcd, target_pcd, voxel_size)
+        else:
+            pose = globalregistration.ransac_based_on_fpfh(source_pcd, target_pcd, voxel_size, fast)
+    log("Cost Time: %.3f sec" % (time.time() - start))
     return pose
 
 
-def mesh_node_to_point_cloud_node(source_node):
-    numOfVertex = source_node.node().getGeom(0).getVertexData().getNumRows()
-
-    _format = GeomVertexFormat.getV3n3c4()
-    vertex_data = GeomVertexData('pc', _format, Geom.UH_static)
-    vertex = GeomVertexWriter(vertex_data, 'vertex')
-    s_vertex = GeomVertexReader(source_node.node().getGeom(0).getVertexData(), 'vertex')
-    while not s_vertex.isAtEnd():
-        vertex.addData3(s_vertex.getData3())
-    normal = GeomVertexWriter(vertex_data, 'normal')
-    s_normal = GeomVertexReader(source_node.node().getGeom(0).getVertexData(), 'normal')
-    while not s_normal.isAtEnd():
-        normal.addData3(s_normal.getData3())
-    color = GeomVertexWriter(vertex_data, 'color')
-    s_color = GeomVertexReader(source_node.node().getGeom(0).getVertexData(), 'color')
-    while not s_color.isAtEnd():
-        color.addData3(s_color.getData3())
-
-    prim = GeomPoints(Geom.UH_static)
-    prim.add_next_vertices(numOfVertex)
-
-    geom = Geom(vertex_data)
-    geom.addPrimitive(prim)
-    node = GeomNode('PointCloud')
-    node.addGeom(geom)
-
-    node = NodePath(node)
-    return node
-
+def pose_store_key(source_node, target_node, voxel_size, method=Method.OPEN3D_GREATEST, pyramid=False, store=None):
+    store = store or posestore.default_store
+    target_pcd = target_node.pcd if isinstance(target_node, TargetIndex) else as_pcd(target_node)
+    return store.key(as_pcd(source_node), target_pcd, method.name, voxel_size, pyramid)
 
-def geom_node_to_pcd(geom_node):
-    pcd = o3d.geometry.PointCloud()
-
-    _format = GeomVertexFormat.getV3t2()
-    s_vertex = GeomVertexReader(geom_node.node().getGeom(0).getVertexData(), 'vertex')
-    while not s_vertex.isAtEnd():
-        vertex = s_vertex.getData3()
-        pcd.points.append(vertex)
 
-    s_normal = GeomVertexReader(geom_node.node().getGeom(0).getVertexData(), 'normal')
-    while not s_normal.isAtEnd():
-        normal = s_normal.getData3()
-        pcd.normals.append(normal)
+def local_registration(source_node, target_node, initial_transformation, voxel_size,
+                       method=Method.OPEN3D_GREATEST, pyramid=False, store=None, callback=None):
+    # with a posestore.PoseStore, a run started near a stored run of the same pair returns the stored result
+    # callback(iteration, transformation, result) follows the Open3D methods iteration by iteration (no pyramid),
+    # see localregistration.live_registration
+    start = time.time()
+    if store is not None:
+        source_node = as_pcd(source_node)
+        key = pose_store_key(source_node, target_node, voxel_size, method, pyramid, store)
+        cached = store.lookup(key, initial_transformation, voxel_size)
+        if cached is not None:
+            log(":: Stored pose reused (fitness %.4f)." % cached['fitness'])
+            return posestore.from_result_pose(cached['resultPose'])
+
+    with stage('local_registration', method=method.name, pyramid=pyramid):
+        if pyramid and method != Method.OPENCV:  # opencv icp already runs its own numLevels pyramid
+            pose = localregistration.pyramid_registration(method, source_node, target_node, initial_transformation,
+                                                          voxel_size)
+        elif callback is not None and method != Method.OPENCV:
+            pose = localregistration.live_registration(method, source_node, target_node, initial_transformation,
+                                                       voxel_size, callback)
+        elif method == Method.OPENCV: # TODO: 지금 작동 안됨...
+            pose = localregistration.opencv_icp(source_node, target_node, initial_transformation)
+        elif method == Method.OPEN3D_DEFAULT:
+            pose = localregistration.open3d_icp(source_node, target_node, initial_transformation, voxel_size)
+        elif method == Method.OPEN3D_GREATEST:
+            pose = localregistration.open3d_gicp(source_node, target_node, initial_transformation, voxel_size)
+        elif method == Method.OPEN3D_COLORED:
+            pose = localregistration.colored_icp(source_node, target_node, initial_transformation, voxel_size)
+    log("Cost Time: %.3f sec" % (time.time() - start))
+
+    if store is not None:
+        target_pcd = target_node.pcd if isinstance(target_node, TargetIndex) else as_pcd(target_node)
+        evaluation = o3d.pipelines.registration.evaluate_registration(source_node, target_pcd, voxel_size * 0.4,
+                                                                      np.asarray(pose))
+        store.add(key, initial_transformation, pose, evaluation.fitness, evaluation.inlier_rmse)
+    return pose
 
-    s_color = GeomVertexReader(geom_node.node().getGeom(0).getVertexData(), 'color')
-    while not s_color.isAtEnd():
-        color = s_color.getData3()
-        pcd.colors.append(color)
 
+def residual_colors(residuals, max_distance):
+    """uint8 RGB of per-point residuals, green (0) to red (max_distance), grey for points without a match."""
+    ratio = np.clip(residuals / max_distance, 0, 1)
+    colors = np.zeros((len(residuals), 3), dtype=np.uint8)
+    colors[:, 0] = np.rint(ratio * 255)
+    colors[:, 1] = np.rint((1 - ratio) * 255)
+    colors[~np.isfinite(residuals)] = 128
+    return colors
+
+
+def load_mesh_node(filename):
+    # same as ShowBase.loader.loadModel, but usable without a window
+    if pcformat.is_native(filename):
+        return pcformat.load_geom_node(filename)
+
+    filename = Filename.fromOsSpecific(os.path.abspath(filename))
+    model = Loader.getGlobalPtr().loadSync(filename)
+    if model is None:
+        raise IOError("Could not load model file: %s" % filename)
+    return NodePath(model).findAllMatches('**/+GeomNode')[0]
+
+
+def load_pcd(filename):
+    """Open3D point cloud of a model file, with the vertices the App shows for it."""
+    with stage('load', file=os.path.basename(filename)) as record:
+        if pcformat.is_native(filename):
+            pcd = pcformat.load_pcd(filename)
+        elif os.path.splitext(filename)[1].lower() == '.ply':
+            pcd = read_pointcloud(filename)
+        else:
+            pcd = geom_node_to_pcd(mesh_node_to_point_cloud_node(load_mesh_node(filename)))
+        record['points_out'] = len(pcd.points)
     return pcd
 
 
-def pcd_to_geom_node(pcd):
-    num_of_vertex = len(pcd.points)
-
-    _format = GeomVertexFormat.getV3n3c4()
-    vertex_data = GeomVertexData('pc', _format, Geom.UHDynamic)
-    vertex_data.setNumRows(2)
-
-    vertex = GeomVertexWriter(vertex_data, 'vertex')
-    normal = GeomVertexWriter(vertex_data, 'normal')
-    color = GeomVertexWriter(vertex_data, 'color')
-
-    for point in pcd.points:
-        vertex.addData3(point[0], point[1], point[2])
-    for point_normal in pcd.normals:
-        normal.addData3(point_normal[0], point_normal[1], point_normal[2])
-    for point_color in pcd.colors:
-        color.addData3(point_color[0], point_color[1], point_color[2])
-
-    prim = GeomPoints(Geom.UH_static)
-    prim.add_next_vertices(num_of_vertex)
-    geom = Geom(vertex_data)
-    geom.addPrimitive(prim)
-
-    node = GeomNode('PointCloud')
-    node.addGeom(geom)
-    node = NodePath(node)
-    return node
-
-
-def geom_node_to_numpy_pc(geom_node):
-    array = [[], []]
-    vertices = []
-
-    _format = GeomVertexFormat.getV3t2()
-    s_vertex = GeomVertexReader(geom_node.node().getGeom(0).getVertexData(), 'vertex')
-    while not s_vertex.isAtEnd():
-        vertex = s_vertex.getData3()
-        array[0].append(vertex)
-
-    s_normal = GeomVertexReader(geom_node.node().getGeom(0).getVertexData(), 'normal')
-    while not s_normal.isAtEnd():
-        normal = s_normal.getData3()
-        array[1].append(normal)
-
-    component_count = 6
-    has_normal = len(array[1]) > 0
-    if has_normal:
-        for i in range(len(array[1])):
-            vertex = array[0][i]
-            normal = array[1][i]
-            vertices.append([vertex[0], vertex[1], vertex[2], normal[0], normal[1], normal[2]])
-
-    else:
-        component_count = 3
-        vertices = array[0]
-
-    return np.array(vertices).reshape((-1, component_count)).astype(np.float32)
+def load_cloud(filename):
+    """CompactCloud of a model file, the vertices of load_pcd without the float64 copy (.npc files are borrowed)."""
+    name = os.path.basename(filename)
+    with stage('load', file=name) as record:
+        if pcformat.is_native(filename):
+            cloud = CompactCloud(*pcformat.read(filename), name=name)
+        elif os.path.splitext(filename)[1].lower() == '.ply':
+            cloud = CompactCloud.from_tensor_pcd(o3d.t.io.read_point_cloud(filename))
+        else:
+            cloud = CompactCloud.from_geom_node(load_mesh_node(filename))
+        cloud.name = name
+        record['points_out'] = len(cloud)
+    return cloud
 
 
 def read_pointcloud(filename):
@@ -194,13 +197,51 @@ def read_mesh_to_pointcloud(filename):
     return pcd
 
 
+def _process(cloud, voxel_size, filters):
+    # raw clouds are down sampled as a CompactCloud, the filters need an Open3D one
+    if filters is not None:
+        cloud, _ = filtering.filter_pcd(as_pcd(cloud), voxel_size, filters)
+    elif isinstance(cloud, NodePath):
+        cloud = CompactCloud.from_geom_node(cloud)
+    return down_sampling(cloud, voxel_size)
+
+
 def down_sampling(pcd, voxel_size):
-    print(":: Downsample with a voxel size %.3f." % voxel_size)
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-    radius_normal = voxel_size * 2
-    print(":: Estimate normal with search radius %.3f." % radius_normal)
-    pcd_down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
-    return pcd_down
+    """pcd is an Open3D PointCloud or a CompactCloud, returns an Open3D PointCloud with normals."""
+    log(":: Downsample with a voxel size %.3f." % voxel_size)
+    if isinstance(pcd, CompactCloud):
+        pcd_down = pcd.voxel_down_sample(voxel_size).to_pcd()
+    else:
+        with stage('downsample', points_in=len(pcd.points), voxel_size=voxel_size) as record:
+            pcd_down = pcd.voxel_down_sample(voxel_size)
+            record['points_out'] = len(pcd_down.points)
+    return estimate_normals(pcd_down, voxel_size)
+
+
+def estimate_normals(pcd, voxel_size):
+    radius_normal = voxel_size * normal_radius_factor
+    log(":: Estimate normal with search radius %.3f." % radius_normal)
+    with stage('normals', points_in=len(pcd.points)):
+        pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=normal_max_nn))
+    return pcd
+
+
+def stream_process_pcd(filepath, voxel_size, cache=None, chunk_points=streaming.default_chunk_points):
+    """process_pcd for files too large to load: the file is down sampled while it is read, then gets normals.
+
+    Noise filtering needs the whole cloud and is not available here. Results are cached like process_pcd's.
+    """
+    if cache is None:
+        cache = processcache.default_cache
+    key = cache.key(filepath, voxel_size, voxel_size * normal_radius_factor, normal_max_nn, 'stream')
+    processed = cache.get(key)
+    if processed is None:
+        processed = estimate_normals(streaming.stream_down_sample(filepath, voxel_size, chunk_points).to_pcd(),
+                                     voxel_size)
+        cache.put(key, processed)
+    else:
+        log(":: Processed point cloud loaded from cache (%d points)." % len(processed.points))
+    return processed
 
 
 def print_matrix(matrix):
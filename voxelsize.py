@@ -0,0 +1,134 @@
+"""Automatic voxel size selection.
+
+The voxel size drives every derived distance (normal radius, FPFH radius, RANSAC/ICP thresholds), so a source and
+target pair shares one value. It is picked either for a point count (no down sampled cloud above target_points) or
+for a global registration time budget (probing the pipeline at a few point counts). Point counts are hit by
+bisection over the voxel size: the down sampled point count falls monotonically with it, and counting voxels is
+cheap next to the rest of the pipeline. The raw clouds are searched as CompactClouds, in float32, and only the probes
+of a budget search build down sampled Open3D clouds.
+"""
+import math
+import time
+
+import numpy as np
+import open3d as o3d
+from panda3d.core import NodePath
+
+import featurecache
+import globalregistration
+import util
+from compactcloud import CompactCloud
+from instrumentation import log, stage
+
+
+min_points = 300  # below this FPFH/RANSAC become unreliable, budgets never go lower
+
+
+def _rounded(voxel_size):
+    # up to 3 significant digits, so repeated selections hit the processed cloud cache; rounding up never adds points
+    scale = 10.0 ** (2 - math.floor(math.log10(voxel_size)))
+    return math.ceil(voxel_size * scale) / scale
+
+
+def _compact(cloud):
+    if isinstance(cloud, CompactCloud):
+        return cloud
+    if isinstance(cloud, NodePath):
+        return CompactCloud.from_geom_node(cloud)
+    return CompactCloud.from_pcd(util.as_pcd(cloud))
+
+
+def point_spacing(cloud, samples=10000, seed=0):
+    """Median distance to the nearest neighbor, over a random sample of the points of a CompactCloud."""
+    nns = o3d.core.nns.NearestNeighborSearch(o3d.core.Tensor(cloud.points))
+    nns.knn_index()
+    picks = np.random.default_rng(seed).choice(len(cloud), min(samples, len(cloud)), replace=False)
+    _, squared_distances = nns.knn_search(o3d.core.Tensor(cloud.points[picks]), 2)
+    return float(np.median(np.sqrt(squared_distances.numpy()[:, 1])))
+
+
+def _count(clouds, voxel_size):
+    return sum(cloud.voxel_count(voxel_size) for cloud in clouds)
+
+
+def _bisect(clouds, target_points, tolerance=0.05, max_steps=20):
+    """Smallest voxel size found that leaves at most target_points points, stops within tolerance below it."""
+    # geometric bisection between the point spacing (no reduction) and the cloud extent (a handful of points)
+    low = min(point_spacing(cloud) for cloud in clouds) * 0.5
+    high = max(float(np.max(np.subtract(*cloud.bounds()[::-1]))) for cloud in clouds)
+    if _count(clouds, low) <= target_points:
+        return low
+    best = high
+    for _ in range(max_steps):
+        voxel_size = np.sqrt(low * high)
+        count = _count(clouds, voxel_size)
+        if count > target_points:
+            low = voxel_size
+            continue
+        high = best = voxel_size
+        if count >= (1 - tolerance) * target_points:
+            break
+    return best
+
+
+def voxel_size_for_points(clouds, target_points, tolerance=0.05):
+    """Smallest voxel size that leaves no cloud with more than target_points points (within tolerance)."""
+    with stage('voxel_size', target_points=target_points) as record:
+        voxel_size = _rounded(max(_bisect([pcd], target_points, tolerance) for pcd in clouds))
+        record['voxel_size'] = voxel_size
+    log(":: Voxel size %.4g for at most %d points per cloud." % (voxel_size, target_points))
+    return voxel_size
+
+
+def _probe(source, target, voxel_size):
+    # down sampling + normals + FPFH + RANSAC at one voxel size, features computed from scratch, with the criteria
+    # of a real registration: a capped probe would miss the iterations a real run spends before its confidence
+    start = time.perf_counter()
+    source_down = util.down_sampling(source, voxel_size)
+    target_down = util.down_sampling(target, voxel_size)
+    cache = featurecache.FeatureCache(max_entries=2)
+    globalregistration.ransac(source_down, target_down, globalregistration.fpfh(source_down, voxel_size, cache),
+                              globalregistration.fpfh(target_down, voxel_size, cache), voxel_size * 1.5)
+    return len(source_down.points) + len(target_down.points), time.perf_counter() - start
+
+
+def voxel_size_for_budget(source, target, budget, start_points=2000, max_probes=4, tolerance=0.2):
+    """Voxel size for which down sampling and global registration of the pair take about budget seconds.
+
+    The cost grows faster than linearly with the point count, so the search probes the pipeline at a point count,
+    fits seconds = a * points ** k through the last two probes and moves toward the budget (at most 4x per step).
+    A probe is a full registration (up to 100000 RANSAC iterations, stopping at its confidence), so its time is what
+    the pipeline will take; the small first probe and the bounded steps keep each probe near the budget.
+    """
+    with stage('voxel_size', budget=budget) as record:
+        exponent = 1.0
+        samples = []
+        points = start_points
+        for _ in range(max_probes):
+            voxel_size = _bisect([source, target], points)
+            count, seconds = _probe(source, target, voxel_size)
+            samples.append((count, seconds, voxel_size))
+            if abs(seconds - budget) <= tolerance * budget:
+                break
+            if len(samples) >= 2:
+                (n0, t0, _), (n1, t1, _) = samples[-2:]
+                if n0 != n1 and t0 > 0 and t1 > 0:
+                    exponent = float(np.clip(np.log(t1 / t0) / np.log(n1 / n0), 0.5, 3.0))
+            factor = float(np.clip((budget / seconds) ** (1 / exponent), 0.25, 4.0))
+            points = max(int(count * factor), min_points)
+        else:
+            voxel_size = _bisect([source, target], points)
+
+        voxel_size = _rounded(voxel_size)
+        record.update(voxel_size=voxel_size, target_points=points, probes=len(samples), exponent=exponent)
+    log(":: Voxel size %.4g for a %.3f sec budget (%d points, %d probes)."
+        % (voxel_size, budget, points, len(samples)))
+    return voxel_size
+
+
+def select(source, target, target_points=None, budget=None):
+    """One voxel size for the raw source/target pair, for a point count per cloud or a time budget in seconds."""
+    source, target = _compact(source), _compact(target)
+    if budget is not None:
+        return voxel_size_for_budget(source, target, budget)
+    return voxel_size_for_points([source, target], target_points)